@@ -8,8 +8,26 @@ import io
 import unicodedata
 import re
 import requests
+import threading
+import queue
+import time
+import sqlite3
+import contextlib
+import collections
+import bisect
+import functools
+import logging
+import random
+import uuid
+import hashlib
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as EsperaAgotada
+from PIL import Image, ImageOps
 from datetime import datetime
 
+# Copy-on-Write: las copias de la caché comparten la memoria de las columnas hasta que alguien
+# escribe en ellas (en pandas 3 ya viene activado)
+if int(pd.__version__.split(".")[0]) < 3: pd.set_option("mode.copy_on_write", True)
+
 # --- CONFIGURACIÓN DE PÁGINA ---
 st.set_page_config(page_title="Pedido de Ayuda Escolar", layout="wide", page_icon="📚")
 
@@ -40,6 +58,49 @@ COLUMNAS_ESTRICTAS = [
     "Comprobante", "Comprobante2", "Historial_Cambios"
 ]
 
+def leer_secreto(clave, defecto):
+    try: return st.secrets.get(clave, defecto)
+    except: return defecto
+
+# Segundos que una hoja leída se reutiliza entre reruns y sesiones
+CACHE_TTL = int(leer_secreto("CACHE_TTL", 60))
+
+# Dónde se guardan los datos: "sheets", "sqlite" o "sqlite+sheets"
+ALMACEN = str(leer_secreto("ALMACEN", "sheets")).lower()
+SQLITE_RUTA = leer_secreto("SQLITE_RUTA", "libros_escolares.db")
+
+# Minutos entre relecturas completas de Pedidos; entre medio solo se bajan las filas que cambiaron
+SINCRONIZACION_COMPLETA_MIN = float(leer_secreto("SINCRONIZACION_COMPLETA_MIN", 30))
+
+# Milisegundos que el escritor junta guardados de distintas sesiones antes de escribir
+ESCRITURA_VENTANA_MS = int(leer_secreto("ESCRITURA_VENTANA_MS", 150))
+
+# Llamadas por minuto que permite la cuota de la API de Sheets (lecturas por usuario)
+CUOTA_POR_MINUTO = int(leer_secreto("CUOTA_POR_MINUTO", 60))
+# Archivo JSON Lines opcional donde se anota cada corrida del script, para perfilar en producción
+METRICAS_LOG = leer_secreto("METRICAS_LOG", "")
+
+# Carpeta y tope (MB) de las miniaturas de comprobantes que se sirven desde el servidor
+MINIATURAS_RUTA = leer_secreto("MINIATURAS_RUTA", "miniaturas")
+MINIATURAS_MAX_MB = int(leer_secreto("MINIATURAS_MAX_MB", 200))
+
+log = logging.getLogger("app_libros")
+
+@st.cache_resource
+def _errores_almacen():
+    # Las clases se crean una vez por proceso: el script se re-ejecuta en cada interacción, pero el
+    # limitador y la conexión (cache_resource) lanzan las de su primera corrida, y un `except` con
+    # clases nuevas no las atraparía
+    class ErrorAlmacen(Exception):
+        """No se pudo leer o escribir en el almacén (red, permisos, cuota). Nunca se disfraza de tabla vacía."""
+
+    class CuotaAgotada(ErrorAlmacen):
+        """Se llegó al límite de llamadas por minuto de Google Sheets."""
+
+    return ErrorAlmacen, CuotaAgotada
+
+ErrorAlmacen, CuotaAgotada = _errores_almacen()
+
 # --- ESTADO ---
 if 'reset_manual' not in st.session_state: st.session_state.reset_manual = 0
 if 'exito_cliente' not in st.session_state: st.session_state.exito_cliente = False
@@ -58,50 +119,445 @@ def limpiar_moneda(valor):
     except:
         return 0.0
 
+COLUMNAS_MONEDA = ["Total", "Abonado", "Saldo"]
+COLUMNAS_FECHA = ["Fecha_Creacion", "Ultima_Modificacion"]
+
+def limpiar_moneda_serie(serie):
+    # Igual que limpiar_moneda, pero sobre toda la columna de una vez
+    if pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie): return serie.fillna(0.0).astype(float)
+    texto = serie.astype(str).str.strip().str.replace('$', '', regex=False)
+    texto = texto.str.replace(' ', '', regex=False).str.replace(',', '', regex=False)
+    return pd.to_numeric(texto, errors='coerce').fillna(0.0).astype(float)
+
+# --- MÉTRICAS DE RENDIMIENTO ---
+class Metricas:
+    """Tiempos y conteos de las operaciones costosas, compartidos por todas las sesiones.
+
+    Guarda las últimas duraciones de cada operación (para p50/p95), los instantes de las
+    llamadas a la API (para llamadas por minuto) y el resumen de las corridas recientes.
+    """
+    def __init__(self, ventana=500, corridas=200):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.ventana = ventana
+        self.max_corridas = corridas
+        self.reiniciar()
+
+    def reiniciar(self):
+        with self._lock:
+            self.duraciones = {}   # operación -> últimas duraciones (s)
+            self.totales = {}      # operación -> [llamadas, errores, segundos]
+            self.api = collections.deque()
+            self.corridas = collections.deque(maxlen=self.max_corridas)
+
+    def registrar(self, nombre, segundos, api=False, error=False):
+        ahora = time.time()
+        with self._lock:
+            self.duraciones.setdefault(nombre, collections.deque(maxlen=self.ventana)).append(segundos)
+            total = self.totales.setdefault(nombre, [0, 0, 0.0])
+            total[0] += 1
+            total[1] += int(error)
+            total[2] += segundos
+            if api:
+                self.api.append(ahora)
+                while self.api and ahora - self.api[0] > 60: self.api.popleft()
+        # Además se suma a la corrida del script en curso (si este hilo tiene una)
+        corrida = getattr(self._local, "corrida", None)
+        if corrida is not None:
+            op = corrida["ops"].setdefault(nombre, [0, 0.0])
+            op[0] += 1
+            op[1] += segundos
+            if api:
+                corrida["api"] += 1
+                corrida["api_s"] += segundos
+
+    @contextlib.contextmanager
+    def medir(self, nombre, api=False):
+        inicio = time.perf_counter()
+        error = False
+        try: yield
+        except:
+            error = True
+            raise
+        finally: self.registrar(nombre, time.perf_counter() - inicio, api, error)
+
+    def iniciar_corrida(self, vista):
+        self._local.corrida = {"fecha": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "vista": vista,
+                               "inicio": time.perf_counter(), "api": 0, "api_s": 0.0, "ops": {}}
+
+    def corrida_abierta(self):
+        return getattr(self._local, "corrida", None) is not None
+
+    def cerrar_corrida(self):
+        corrida = getattr(self._local, "corrida", None)
+        if corrida is None: return
+        self._local.corrida = None
+        corrida["segundos"] = time.perf_counter() - corrida.pop("inicio")
+        with self._lock: self.corridas.append(corrida)
+        if METRICAS_LOG:
+            try:
+                with self._lock, open(METRICAS_LOG, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(corrida, ensure_ascii=False) + "\n")
+            except Exception as e: log.warning("No se pudo escribir METRICAS_LOG: %s", e)
+
+    def llamadas_ultimo_minuto(self):
+        ahora = time.time()
+        with self._lock: return sum(1 for t in self.api if ahora - t <= 60)
+
+    def resumen(self):
+        # Una fila por operación, con percentiles sobre las últimas duraciones
+        with self._lock: datos = [(n, list(d), list(self.totales[n])) for n, d in self.duraciones.items()]
+        filas = []
+        for nombre, duraciones, (llamadas, errores, total) in datos:
+            ms = pd.Series(duraciones) * 1000
+            filas.append([nombre, llamadas, errores, ms.quantile(0.5), ms.quantile(0.95), ms.max(), total])
+        df = pd.DataFrame(filas, columns=["Operación", "Llamadas", "Errores", "p50 ms", "p95 ms", "Máx ms", "Total s"])
+        return df.sort_values("Total s", ascending=False).reset_index(drop=True)
+
+    def corridas_recientes(self):
+        with self._lock: corridas = list(self.corridas)
+        filas = [[c["fecha"], c["vista"], c["segundos"] * 1000, c["api"], c["api_s"] * 1000,
+                  ", ".join(f"{n}×{v[0]}" for n, v in sorted(c["ops"].items(), key=lambda o: -o[1][1])[:4])] for c in corridas]
+        return pd.DataFrame(filas, columns=["Fecha", "Vista", "Duración ms", "Llamadas API", "API ms", "Operaciones principales"])
+
+@st.cache_resource
+def obtener_metricas():
+    return Metricas()
+
+def medido(nombre):
+    # Decorador para funciones locales costosas: registra cada llamada en las métricas
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            with obtener_metricas().medir(nombre): return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+def mostrar_error_almacen(e):
+    # Sin datos confiables se corta la página (o el fragmento): nada llega a guardar sobre una tabla vacía
+    log.error("Lectura fallida: %s", e)
+    st.error(f"⚠️ No se pudieron cargar los datos: {e}. Intenta de nuevo en un momento.")
+
+def fragmento(vista):
+    """Como st.fragment, pero cada re-ejecución suelta del fragmento es una corrida en Rendimiento.
+
+    Dentro de la corrida de la página el cuerpo suma a esa corrida. Un ErrorAlmacen se muestra
+    como en la página completa en lugar de dejar la traza del fragmento.
+    """
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            metricas = obtener_metricas()
+            propia = not metricas.corrida_abierta()
+            if propia: metricas.iniciar_corrida(vista)
+            try: return funcion(*args, **kwargs)
+            except ErrorAlmacen as e: mostrar_error_almacen(e)
+            finally:
+                if propia: metricas.cerrar_corrida()
+        return st.fragment(envoltura)
+    return decorador
+
+# --- PUERTA DE LA API (CUOTA Y REINTENTOS) ---
+class LimitadorApi:
+    """Cuenta las llamadas a Google en una ventana deslizante de 60 s contra CUOTA_POR_MINUTO.
+
+    Las llamadas críticas (guardados, primeras lecturas) esperan turno cuando se llega a la
+    cuota. Las lecturas marcadas con no_critica() se descartan con CuotaAgotada desde el
+    UMBRAL, para dejar el cupo que queda a los guardados.
+    """
+    UMBRAL = 0.8
+
+    def __init__(self, cuota):
+        self.cuota = max(int(cuota), 1)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._llamadas = collections.deque()
+        self._pausa_hasta = 0.0
+        self.descartadas = 0
+
+    @contextlib.contextmanager
+    def no_critica(self):
+        previo = getattr(self._local, "no_critica", False)
+        self._local.no_critica = True
+        try: yield
+        finally: self._local.no_critica = previo
+
+    def pausar(self, segundos):
+        # Google ya respondió 429: nadie llama hasta que pase la espera
+        with self._lock: self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+
+    def tomar(self):
+        no_critica = getattr(self._local, "no_critica", False)
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                while self._llamadas and ahora - self._llamadas[0] >= 60: self._llamadas.popleft()
+                usadas = len(self._llamadas)
+                if no_critica and (usadas >= self.UMBRAL * self.cuota or ahora < self._pausa_hasta):
+                    self.descartadas += 1
+                    raise CuotaAgotada(f"Cuota de Google Sheets casi agotada ({usadas}/{self.cuota} por minuto)")
+                if usadas < self.cuota and ahora >= self._pausa_hasta:
+                    self._llamadas.append(ahora)
+                    return
+                espera = max(self._pausa_hasta - ahora, 60 - (ahora - self._llamadas[0]) if usadas >= self.cuota else 0)
+            time.sleep(min(max(espera, 0.05), 1.0))
+
+@st.cache_resource
+def obtener_limitador():
+    return LimitadorApi(CUOTA_POR_MINUTO)
+
+def codigo_http(error):
+    respuesta = getattr(error, "response", None)
+    return getattr(respuesta, "status_code", None)
+
+class ApiSheets:
+    """Envuelve un objeto de gspread (cliente, libro u hoja): toda llamada a Google pasa por aquí.
+
+    Cada método espera turno en el limitador, se mide como "api.<método>" y se reintenta
+    ante 429, errores 5xx o cortes de red con espera exponencial con jitter. Lo que devuelven
+    open_by_key / worksheet / worksheets / add_worksheet también se envuelve.
+    """
+    DEVUELVEN_OBJETOS = {"open_by_key", "worksheet", "worksheets", "add_worksheet"}
+    # Ante un 5xx o un corte Google pudo haberlas aplicado: repetirlas duplicaría o borraría filas de más
+    NO_REPETIBLES = {"append_rows", "append_row", "delete_rows", "add_worksheet"}
+    REINTENTOS = 4
+    ESPERA_BASE = 1.0
+    ESPERA_MAX = 32.0
+
+    def __init__(self, objeto, metricas, limitador):
+        self._objeto = objeto
+        self._metricas = metricas
+        self._limitador = limitador
+
+    def _envolver(self, objeto):
+        return ApiSheets(objeto, self._metricas, self._limitador)
+
+    def __getattr__(self, nombre):
+        atributo = getattr(self._objeto, nombre)
+        if not callable(atributo): return atributo
+        def llamada(*args, **kwargs):
+            for intento in range(self.REINTENTOS + 1):
+                self._limitador.tomar()
+                try:
+                    with self._metricas.medir(f"api.{nombre}", api=True): resultado = atributo(*args, **kwargs)
+                    break
+                except (gspread.exceptions.APIError, requests.exceptions.RequestException) as e:
+                    codigo = codigo_http(e)
+                    repetible = codigo == 429 or ((codigo is None or codigo >= 500) and nombre not in self.NO_REPETIBLES)
+                    if not repetible or intento == self.REINTENTOS:
+                        if codigo == 429: raise CuotaAgotada(f"Google Sheets rechazó {nombre} por cuota (429)") from e
+                        raise
+                    espera = random.uniform(0, min(self.ESPERA_MAX, self.ESPERA_BASE * 2 ** intento))
+                    if codigo == 429: self._limitador.pausar(espera)
+                    self._metricas.registrar("reintento_api", espera)
+                    log.warning("%s falló (%s); reintento %d en %.1f s", nombre, codigo or e, intento + 1, espera)
+                    time.sleep(espera)
+            if nombre not in self.DEVUELVEN_OBJETOS: return resultado
+            if isinstance(resultado, list): return [self._envolver(r) for r in resultado]
+            return self._envolver(resultado)
+        return llamada
+
 # --- CONEXIÓN GOOGLE SHEETS ---
+def autorizar_cliente():
+    json_str = st.secrets["google_json"]
+    creds_dict = json.loads(json_str)
+    creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
+    return gspread.authorize(creds)
+
+class ConexionSheets:
+    """Cliente, libro y hojas resueltos una sola vez por proceso.
+
+    Solo se vuelven a pedir a Google si el token vence (401) o si una hoja
+    guardada ya no existe (400/404); en ese caso la operación se reintenta una vez.
+    Cuota y errores transitorios los resuelve ApiSheets en cada llamada.
+    """
+    def __init__(self, client, metricas, limitador):
+        self.metricas = metricas
+        self.limitador = limitador
+        self.client = ApiSheets(client, metricas, limitador)
+        self._lock = threading.Lock()
+        self._libro = None
+        self._hojas = {}
+
+    def libro(self):
+        with self._lock:
+            # 🛡️ USAMOS open_by_key PARA ASEGURAR EL ARCHIVO CORRECTO
+            if self._libro is None: self._libro = self.client.open_by_key(SHEET_ID)
+            return self._libro
+
+    def hoja(self, nombre, crear=None):
+        with self._lock: wk = self._hojas.get(nombre)
+        if wk is not None: return wk
+        libro = self.libro()
+        try: wk = libro.worksheet(nombre)
+        except gspread.exceptions.WorksheetNotFound:
+            if crear is None: raise
+            wk = crear(libro)
+        with self._lock: self._hojas[nombre] = wk
+        return wk
+
+    def reiniciar(self, reautorizar=False):
+        with self._lock:
+            if reautorizar:
+                self.client = ApiSheets(autorizar_cliente(), self.metricas, self.limitador)
+            self._libro = None
+            self._hojas = {}
+
+    def ejecutar(self, nombre, operacion, crear=None):
+        try: return operacion(self.hoja(nombre, crear))
+        except gspread.exceptions.APIError as e:
+            codigo = codigo_http(e)
+            if codigo not in (400, 401, 404): raise
+            self.reiniciar(reautorizar=codigo == 401)
+            return operacion(self.hoja(nombre, crear))
+
 @st.cache_resource
 def conectar_sheets():
     try:
-        json_str = st.secrets["google_json"]
-        creds_dict = json.loads(json_str)
-        creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
-        client = gspread.authorize(creds)
-        return client
+        return ConexionSheets(autorizar_cliente(), obtener_metricas(), obtener_limitador())
     except Exception as e:
         st.error(f"Error conectando a Google Sheets: {e}")
         return None
 
-# --- GESTIÓN DE CONFIGURACIÓN (NEQUI) ---
-def obtener_celular_nequi():
-    client = conectar_sheets()
-    if not client: return "No configurado"
-    try:
-        # 🛡️ USAMOS open_by_key PARA ASEGURAR EL ARCHIVO CORRECTO
-        sh = client.open_by_key(SHEET_ID)
-        try: wk = sh.worksheet("Config")
-        except:
-            wk = sh.add_worksheet(title="Config", rows=10, cols=2)
-            wk.update([["Clave", "Valor"], ["celular_nequi", "3000000000"]])
-            return "3000000000"
+# --- CACHÉ COMPARTIDA DE HOJAS ---
+class CacheHojas:
+    """Caché de lectura compartida por todas las sesiones, con una entrada por hoja.
+
+    Cada entrada guarda el DataFrame leído, el instante de lectura y una versión que
+    sube con cada cambio. Los guardados actualizan (o invalidan) solo la hoja que tocan.
+    Las estructuras derivadas (índices, tablas calculadas) se guardan con las versiones
+    de las hojas de las que salen y se recalculan solo cuando alguna cambia.
+    Si refrescar una hoja vencida falla (cuota, red), se sigue sirviendo la copia anterior.
+    """
+    def __init__(self, ttl, limitador=None):
+        self.ttl = ttl
+        self.limitador = limitador
+        self._lock = threading.RLock()
+        self._datos = {}
+        self._versiones = {}
+        self._derivados = {}
+        self._actualizadores = {}
+
+    def version(self, hoja):
+        with self._lock: return self._versiones.get(hoja, 0)
+
+    def _subir_version(self, hoja):
+        self._versiones[hoja] = self._versiones.get(hoja, 0) + 1
+
+    def obtener(self, hoja, cargador, copia=True, refrescar=None):
+        """DataFrame de `hoja`, leído con `cargador()` si no está o venció.
+
+        La copia que se devuelve es liviana (Copy-on-Write): las columnas se duplican solo si
+        la sesión escribe en ellas. copia=False devuelve el DataFrame compartido: solo para
+        lectura. Con `refrescar(previo)` una copia vencida se pone al día por deltas: devuelve
+        (df, cambios) o None para releer todo.
+        """
+        with self._lock:
+            entrada = self._datos.get(hoja)
+            if entrada and time.monotonic() - entrada[0] < self.ttl:
+                return entrada[1].copy(deep=False) if copia else entrada[1]
+            version_inicial = self._versiones.get(hoja, 0)
         
-        records = wk.get_all_records()
-        df_conf = pd.DataFrame(records).astype(str)
-        res = df_conf[df_conf['Clave'] == 'celular_nequi']
-        if not res.empty: return res.iloc[0]['Valor']
-        else: return "3000000000"
-    except: return "3000000000"
+        # Refrescar una copia vencida no es urgente: cerca de la cuota se descarta y se usa la anterior
+        refresco = self.limitador.no_critica() if entrada and self.limitador else contextlib.nullcontext()
+        try:
+            with refresco:
+                delta = refrescar(entrada[1]) if entrada and refrescar else None
+                df = delta[0] if delta else cargador()
+        except ErrorAlmacen as e:
+            if not entrada: raise
+            log.warning("Se sirve %s desde la caché vencida: %s", hoja, e)
+            return entrada[1].copy(deep=False) if copia else entrada[1]
+        if df is None: return None
+        with self._lock:
+            # Si alguien guardó mientras leíamos, la copia escrita en caché es más nueva
+            if self._versiones.get(hoja, 0) != version_inicial and hoja in self._datos:
+                df = self._datos[hoja][1]
+                return df.copy(deep=False) if copia else df
+            if delta:
+                # Los derivados que estaban al día reciben los mismos cambios, como en un guardado
+                previas = self._previas(hoja)
+                self._datos[hoja] = (time.monotonic(), df)
+                if delta[1]:
+                    self._subir_version(hoja)
+                    self._actualizar_derivados(previas, delta[1])
+                return df.copy(deep=False) if copia else df
+            anterior = self._datos.get(hoja)
+            if anterior is None or not anterior[1].equals(df): self._subir_version(hoja)
+            self._datos[hoja] = (time.monotonic(), df)
+        return df.copy(deep=False) if copia else df
 
-def guardar_celular_nequi(nuevo_numero):
-    client = conectar_sheets()
-    if not client: return False
-    try:
-        sh = client.open_by_key(SHEET_ID)
-        try: wk = sh.worksheet("Config")
-        except: wk = sh.add_worksheet(title="Config", rows=10, cols=2)
-        wk.clear()
-        wk.update([["Clave", "Valor"], ["celular_nequi", str(nuevo_numero)]])
-        return True
-    except: return False
+    def poner(self, hoja, df):
+        with self._lock:
+            self._datos[hoja] = (time.monotonic(), df.copy(deep=False))
+            self._subir_version(hoja)
+
+    def modificar(self, hoja, funcion, cambios=None):
+        # Escritura directa: aplica el cambio sobre la copia en caché sin volver a leer la hoja
+        with self._lock:
+            entrada = self._datos.get(hoja)
+            if entrada is None:
+                self._subir_version(hoja)
+                return
+            previas = self._previas(hoja)
+            try: self._datos[hoja] = (entrada[0], funcion(entrada[1].copy(deep=False)))
+            except: self._datos.pop(hoja, None)
+            self._subir_version(hoja)
+            if hoja not in self._datos or cambios is None: return
+            self._actualizar_derivados(previas, cambios)
+
+    def _previas(self, hoja):
+        # Versión con la que están calculados los derivados que dependen de `hoja`
+        return {n: self._clave_derivado(hs) for n, (hs, _) in self._actualizadores.items() if hoja in hs}
+
+    def _actualizar_derivados(self, previas, cambios):
+        # Los derivados que estaban al día se actualizan con los mismos cambios
+        for nombre, clave_previa in previas.items():
+            hojas, actualizar = self._actualizadores[nombre]
+            derivado = self._derivados.get(nombre)
+            if not derivado or derivado[0] != clave_previa: continue
+            try: self._derivados[nombre] = (self._clave_derivado(hojas), actualizar(derivado[1], cambios))
+            except: self._derivados.pop(nombre, None)
+
+    def invalidar(self, hoja):
+        with self._lock:
+            self._datos.pop(hoja, None)
+            self._subir_version(hoja)
+
+    def _clave_derivado(self, hojas):
+        return tuple(self._versiones.get(h, 0) for h in hojas)
+
+    def derivado_vigente(self, nombre, hojas):
+        # Valor ya calculado para las versiones actuales, o None sin calcular nada
+        with self._lock:
+            entrada = self._derivados.get(nombre)
+            if entrada and entrada[0] == self._clave_derivado(hojas): return entrada[1]
+        return None
+
+    def derivado(self, nombre, hojas, construir, actualizar=None):
+        """Devuelve la estructura `nombre` calculada a partir de `hojas`.
+
+        `construir()` se llama solo si cambió la versión de alguna hoja; si se da
+        `actualizar(valor, cambios)`, los guardados de pedidos la mantienen al día sin reconstruirla.
+        `construir()` debe leer sus hojas adentro (no recibirlas ya leídas): la clave se toma antes,
+        así un guardado que llegue en medio deja el valor con una clave vieja y se recalcula, en
+        lugar de quedar guardado con datos viejos bajo la versión nueva.
+        """
+        with self._lock:
+            if actualizar: self._actualizadores[nombre] = (tuple(hojas), actualizar)
+            clave = self._clave_derivado(hojas)
+            entrada = self._derivados.get(nombre)
+            if entrada and entrada[0] == clave: return entrada[1]
+        valor = construir()
+        with self._lock:
+            # Otro hilo pudo dejar ya un valor al día: no se pisa con uno de clave vieja
+            entrada = self._derivados.get(nombre)
+            if not (entrada and entrada[0] == self._clave_derivado(hojas)): self._derivados[nombre] = (clave, valor)
+        return valor
+
+@st.cache_resource
+def obtener_cache():
+    return CacheHojas(CACHE_TTL, obtener_limitador())
 
 # --- FUNCIONES AUXILIARES ---
 def normalizar_clave(texto):
@@ -124,79 +580,1430 @@ def obtener_nuevo_id(df_pedidos):
                     if val > max_id: max_id = val
     return f"{max_id + 1:04d}"
 
+def letra_columna(n):
+    letras = ""
+    while n > 0:
+        n, resto = divmod(n - 1, 26)
+        letras = chr(65 + resto) + letras
+    return letras
+
+def clave_id(pid):
+    # get_all_records convierte "0004" en 4: comparamos IDs sin ceros a la izquierda
+    pid = str(pid).strip()
+    return str(int(pid)) if pid.isdigit() else pid
+
+# Formato con el que la app escribe las fechas en la hoja
+FORMATO_FECHA = "%Y-%m-%d %H:%M:%S"
+
+def fechas_serie(serie):
+    # Texto de la hoja -> datetime; lo que no es ISO se intenta como fecha local (día primero)
+    if pd.api.types.is_datetime64_any_dtype(serie): return serie
+    texto = serie.astype(str).str.strip()
+    fechas = pd.to_datetime(texto, format="ISO8601", errors="coerce")
+    resto = fechas.isna() & ~texto.isin(["", "nan", "None", "NaT"])
+    if resto.any(): fechas[resto] = pd.to_datetime(texto[resto], format="mixed", dayfirst=True, errors="coerce")
+    return fechas
+
+def texto_fechas(serie):
+    return fechas_serie(serie).dt.strftime(FORMATO_FECHA).fillna("")
+
+def valor_celda(valor):
+    # Frontera con la hoja: todo viaja como texto; los montos enteros sin ".0" y las fechas en FORMATO_FECHA
+    if valor is None or valor is pd.NaT: return ""
+    if isinstance(valor, datetime): return valor.strftime(FORMATO_FECHA)
+    if isinstance(valor, float):
+        if valor != valor: return ""
+        if valor.is_integer(): return str(int(valor))
+    return str(valor)
+
+# --- ALMACÉN: GOOGLE SHEETS ---
+# Fila de Config con el último ID de pedido entregado
+CLAVE_SECUENCIA = "secuencia_pedidos"
+# Hoja con una fila por ID reservado: A1 = "base", B1 = último ID anterior a la hoja
+HOJA_RESERVAS = "Reservas"
+# Hojas de archivo por temporada: "Pedidos_2024", "Pedidos_2025"...
+PREFIJO_ARCHIVO = "Pedidos_"
+
+def _crear_config(libro):
+    wk = libro.add_worksheet(title="Config", rows=10, cols=3)
+    wk.update([["Clave", "Valor"], ["celular_nequi", "3000000000"]])
+    return wk
+
+class AlmacenSheets:
+    """Persistencia en el libro de Google Sheets (hojas Inventario, Pedidos, Config y Reservas)."""
+    # Más de esta fracción de filas cambiadas (o de tramos sueltos) y conviene releer la hoja entera
+    MAX_FRACCION_DELTA = 0.3
+    MAX_TRAMOS_DELTA = 100
+
+    def __init__(self, conexion):
+        self.conexion = conexion
+        self._bases = {}   # id de la hoja Reservas -> base; si la hoja se vuelve a crear cambia el id
+        self._lectura_completa = 0.0
+
+    def leer_inventario(self):
+        data = self.conexion.ejecutar("Inventario", lambda wk: wk.get_all_records())
+        if not data: return pd.DataFrame(columns=["Grado", "Area", "Libro", "Costo", "Precio Venta"])
+        return pd.DataFrame(data)
+
+    def guardar_inventario(self, df):
+        def escribir(wk):
+            wk.clear()
+            wk.update([df.columns.values.tolist()] + df.values.tolist())
+        self.conexion.ejecutar("Inventario", escribir)
+
+    def leer_pedidos(self):
+        # La columna 1 (ID_Pedido) se lee como texto para conservar los ceros ("0004")
+        data = self.conexion.ejecutar("Pedidos", lambda wk: wk.get_all_records(numericise_ignore=[1]))
+        self._lectura_completa = time.monotonic()
+        if not data: return pd.DataFrame(columns=COLUMNAS_ESTRICTAS)
+        return pd.DataFrame(data)
+
+    def cambios_pedidos(self, previo):
+        """Cambios de Pedidos respecto de `previo` leyendo solo las columnas A:C (ID y fechas).
+
+        Se bajan completas (en un solo batch_get) las filas nuevas y las que tienen otra
+        Ultima_Modificacion; los IDs que ya no están en la columna A salen como 'eliminar'.
+        Devuelve None cuando conviene releer la hoja entera: pasó SINCRONIZACION_COMPLETA_MIN,
+        la hoja se reordenó o cambió demasiado.
+        """
+        if time.monotonic() - self._lectura_completa > SINCRONIZACION_COMPLETA_MIN * 60: return None
+        def leer(wk):
+            indice = wk.get_values("A1:C")
+            if not indice or indice[0][:3] != COLUMNAS_ESTRICTAS[:3]: return None
+            remotas = [clave_id(f[0]) if f else "" for f in indice[1:]]
+            fechas = [str(f[2]) if len(f) > 2 else "" for f in indice[1:]]
+            locales = previo['ID_Pedido'].map(clave_id).tolist()
+            if len(set(remotas)) != len(remotas) or len(set(locales)) != len(locales): return None
+            fecha_local = dict(zip(locales, texto_fechas(previo['Ultima_Modificacion'])))
+            # Las filas que siguen deben estar en el mismo orden y las nuevas, al final
+            presentes = set(remotas)
+            restantes = [c for c in locales if c in presentes]
+            conocidas = [c for c in remotas if c in fecha_local]
+            if conocidas != restantes: return None
+            nuevas = [i for i, c in enumerate(remotas) if c not in fecha_local]
+            if nuevas and nuevas[0] < len(conocidas): return None
+            # Una fecha escrita a mano en otro formato no cuenta como cambio si es el mismo instante
+            distintas = [i for i, c in enumerate(remotas) if c in fecha_local and fecha_local[c] != fechas[i]]
+            for i, f in zip(distintas, texto_fechas(pd.Series([fechas[i] for i in distintas], dtype=object))): fechas[i] = f
+            bajar = [i for i, c in enumerate(remotas) if c not in fecha_local or fecha_local[c] != fechas[i]]
+            if len(bajar) > self.MAX_FRACCION_DELTA * max(len(remotas), 1): return None
+            tramos = []
+            for i in bajar:
+                if tramos and tramos[-1][1] == i - 1: tramos[-1][1] = i
+                else: tramos.append([i, i])
+            if len(tramos) > self.MAX_TRAMOS_DELTA: return None
+            ultima = letra_columna(len(COLUMNAS_ESTRICTAS))
+            rangos = [f"A{inicio + 2}:{ultima}{fin + 2}" for inicio, fin in tramos]
+            bloques = wk.batch_get(rangos) if rangos else []
+            cambios = [{"tipo": "eliminar", "id": c} for c in locales if c not in presentes]
+            for (inicio, fin), bloque in zip(tramos, bloques):
+                for i in range(inicio, fin + 1):
+                    fila = list(bloque[i - inicio]) if i - inicio < len(bloque) else []
+                    campos = dict(zip(COLUMNAS_ESTRICTAS, fila + [""] * (len(COLUMNAS_ESTRICTAS) - len(fila))))
+                    tipo = "actualizar" if remotas[i] in fecha_local else "insertar"
+                    cambios.append({"tipo": tipo, "id": campos["ID_Pedido"], "campos": campos})
+            return cambios
+        return self.conexion.ejecutar("Pedidos", leer)
+
+    def guardar_cambios(self, cambios):
+        # Las filas se ubican por ID_Pedido leyendo únicamente la columna A
+        def escribir(wk):
+            ids = wk.col_values(1)
+            if not ids:
+                wk.update([COLUMNAS_ESTRICTAS])
+                ids = ["ID_Pedido"]
+            filas, repetidos = {}, set()
+            for i, v in enumerate(ids[1:], start=2):
+                if clave_id(v) in filas: repetidos.add(clave_id(v))
+                filas[clave_id(v)] = i
+            # Con un ID repetido en la hoja no se sabe qué fila es el pedido: se rechaza antes de escribir
+            tocados = sorted({clave_id(c['id']) for c in cambios} & repetidos)
+            if tocados: raise ErrorAlmacen(f"Pedido repetido en la hoja ({', '.join(tocados)}); usa 'Compactar / Reparar Pedidos'")
+            
+            rangos, nuevas, borrar = [], [], []
+            for cambio in cambios:
+                fila = filas.get(clave_id(cambio['id']))
+                campos = cambio.get('campos', {})
+                completo = all(c in campos for c in COLUMNAS_ESTRICTAS)
+                if cambio['tipo'] == 'eliminar':
+                    if fila: borrar.append(fila)
+                elif fila:
+                    if completo:
+                        ultima = letra_columna(len(COLUMNAS_ESTRICTAS))
+                        valores = [valor_celda(campos[c]) for c in COLUMNAS_ESTRICTAS]
+                        rangos.append({"range": f"A{fila}:{ultima}{fila}", "values": [valores]})
+                    else:
+                        for col, val in campos.items():
+                            if col not in COLUMNAS_ESTRICTAS: continue
+                            letra = letra_columna(COLUMNAS_ESTRICTAS.index(col) + 1)
+                            rangos.append({"range": f"{letra}{fila}", "values": [[valor_celda(val)]]})
+                elif cambio['tipo'] == 'insertar' or completo:
+                    registro = dict(campos, ID_Pedido=cambio['id'])
+                    nuevas.append([valor_celda(registro.get(c, "")) for c in COLUMNAS_ESTRICTAS])
+            
+            if rangos: wk.batch_update(rangos)
+            # Filas contiguas en un solo delete_rows, de abajo hacia arriba para que los índices sigan siendo válidos
+            tramos = []
+            for fila in sorted(set(borrar)):
+                if tramos and tramos[-1][1] == fila - 1: tramos[-1][1] = fila
+                else: tramos.append([fila, fila])
+            for inicio, fin in reversed(tramos): wk.delete_rows(inicio, fin)
+            if nuevas: wk.append_rows(nuevas)
+        self.conexion.ejecutar("Pedidos", escribir)
+
+    def reescribir_pedidos(self, df):
+        filas = [[valor_celda(v) for v in fila] for fila in df[COLUMNAS_ESTRICTAS].itertuples(index=False, name=None)]
+        def escribir(wk):
+            wk.clear()
+            wk.update([COLUMNAS_ESTRICTAS] + filas)
+        self.conexion.ejecutar("Pedidos", escribir)
+
+    def leer_config(self):
+        records = self.conexion.ejecutar("Config", lambda wk: wk.get_all_records(), crear=_crear_config)
+        if not records: return pd.DataFrame(columns=["Clave", "Valor"])
+        return pd.DataFrame(records)[["Clave", "Valor"]].astype(str)
+
+    def guardar_config(self, df_conf):
+        # Solo se escriben las claves recibidas; las demás filas (p. ej. la secuencia) se conservan
+        def escribir(wk):
+            claves = wk.col_values(1)
+            if not claves:
+                wk.update([["Clave", "Valor"]])
+                claves = ["Clave"]
+            rangos, nuevas = [], []
+            for clave, valor in df_conf[["Clave", "Valor"]].astype(str).values.tolist():
+                if clave in claves: rangos.append({"range": f"B{claves.index(clave) + 1}", "values": [[valor]]})
+                else: nuevas.append([clave, valor])
+            if rangos: wk.batch_update(rangos)
+            if nuevas: wk.append_rows(nuevas)
+        self.conexion.ejecutar("Config", escribir, crear=_crear_config)
+
+    def temporadas_archivadas(self):
+        hojas = self.conexion.libro().worksheets()
+        return sorted(wk.title[len(PREFIJO_ARCHIVO):] for wk in hojas if wk.title.startswith(PREFIJO_ARCHIVO))
+
+    def leer_archivo(self):
+        partes = []
+        for temporada in self.temporadas_archivadas():
+            data = self.conexion.ejecutar(PREFIJO_ARCHIVO + temporada, lambda wk: wk.get_all_records(numericise_ignore=[1]))
+            if data: partes.append(pd.DataFrame(data).assign(Temporada=temporada))
+        if not partes: return pd.DataFrame(columns=COLUMNAS_ESTRICTAS + ["Temporada"])
+        return pd.concat(partes, ignore_index=True)
+
+    def archivar_pedidos(self, temporada, df):
+        # Se agregan al final de la hoja de la temporada (se crea si no existe)
+        nombre = PREFIJO_ARCHIVO + temporada
+        def crear(libro):
+            wk = libro.add_worksheet(title=nombre, rows=len(df) + 1, cols=len(COLUMNAS_ESTRICTAS))
+            wk.update([COLUMNAS_ESTRICTAS])
+            return wk
+        filas = [[valor_celda(v) for v in fila] for fila in df[COLUMNAS_ESTRICTAS].itertuples(index=False, name=None)]
+        self.conexion.ejecutar(nombre, lambda wk: wk.append_rows(filas), crear=crear)
+
+    def _semilla_secuencia(self):
+        # Solo al crear la hoja Reservas, cuando Config aún no tiene la fila de la secuencia
+        ids = self.conexion.ejecutar("Pedidos", lambda wk: wk.col_values(1))
+        return int(obtener_nuevo_id(pd.DataFrame({'ID_Pedido': ids[1:]}))) - 1
+
+    def _crear_reservas(self, libro):
+        # La base sale del contador de Config (instalaciones anteriores) o del mayor ID de Pedidos
+        conf = self.leer_config()
+        previo = str(dict(zip(conf['Clave'], conf['Valor'])).get(CLAVE_SECUENCIA, "")).strip()
+        base = max(int(previo) if previo.isdigit() else 0, self._semilla_secuencia())
+        wk = libro.add_worksheet(title=HOJA_RESERVAS, rows=1000, cols=2)
+        wk.update([["base", str(base)]], "A1:B1")
+        return wk
+
+    def _base_reservas(self, wk):
+        # La base no cambia: se lee una vez por proceso (None si la hoja aún no la tiene)
+        if wk.id not in self._bases:
+            cabecera = wk.get_values("A1:B1")
+            fila = cabecera[0] if cabecera else []
+            if len(fila) < 2 or fila[0] != "base" or not str(fila[1]).strip().isdigit(): return None
+            self._bases[wk.id] = int(fila[1])
+        return self._bases[wk.id]
+
+    def siguiente_id(self, intentos=5):
+        """Reserva el siguiente ID de pedido agregando una fila propia a la hoja Reservas.
+
+        Sheets no tiene compare-and-set, pero un append_rows con INSERT_ROWS siempre cae en
+        una fila nueva: el ID es base + fila - 1, así que dos reservas nunca comparten ID,
+        aunque una llamada espere la cuota. La fila se relee para confirmar la marca propia.
+        Cuesta 2 llamadas por reserva (una más la primera vez en cada proceso), sin candados
+        ni pausas. Límites: la hoja no se ordena ni se le borran filas (cambiaría los IDs ya
+        entregados) y una reserva fallida deja un hueco en la numeración.
+        """
+        def reservar(wk):
+            for intento in range(intentos):
+                base = self._base_reservas(wk)
+                if base is None:
+                    # Otro proceso acaba de crear la hoja y aún no escribe la base
+                    time.sleep(0.2 * (intento + 1))
+                    continue
+                marca = uuid.uuid4().hex
+                respuesta = wk.append_rows([[marca, datetime.now().strftime(FORMATO_FECHA)]], value_input_option="RAW",
+                                           insert_data_option="INSERT_ROWS", table_range="A1")
+                rango = re.search(r"![A-Z]+(\d+)", (respuesta or {}).get("updates", {}).get("updatedRange", ""))
+                fila = int(rango.group(1)) if rango else 0
+                leido = wk.get_values(f"A{fila}") if fila > 1 else []
+                if leido and leido[0] and leido[0][0] == marca: return f"{base + fila - 1:04d}"
+            raise RuntimeError("No se pudo reservar un número de pedido, intente de nuevo")
+        return self.conexion.ejecutar(HOJA_RESERVAS, reservar, crear=self._crear_reservas)
+
+# --- ALMACÉN: SQLITE LOCAL ---
+class AlmacenSQLite:
+    """Persistencia local en SQLite, sin red: sirve como almacén principal o para pruebas de carga.
+
+    Los pedidos se guardan como texto (igual que en la hoja) con índice único por ID y
+    un índice por celular normalizado; cada lista de cambios se aplica en una transacción.
+    """
+    def __init__(self, ruta):
+        self.ruta = ruta
+        columnas = ", ".join(f'"{c}" TEXT NOT NULL DEFAULT \'\'' for c in COLUMNAS_ESTRICTAS)
+        with self._transaccion() as con:
+            con.execute(f"""CREATE TABLE IF NOT EXISTS pedidos (
+                orden INTEGER PRIMARY KEY AUTOINCREMENT,
+                clave TEXT NOT NULL UNIQUE,
+                celular_limpio TEXT NOT NULL DEFAULT '',
+                {columnas})""")
+            con.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_celular ON pedidos (celular_limpio)")
+            con.execute(f"""CREATE TABLE IF NOT EXISTS pedidos_archivo (
+                temporada TEXT NOT NULL,
+                clave TEXT NOT NULL UNIQUE,
+                celular_limpio TEXT NOT NULL DEFAULT '',
+                {columnas})""")
+            con.execute("CREATE INDEX IF NOT EXISTS idx_archivo_temporada ON pedidos_archivo (temporada)")
+            con.execute("CREATE TABLE IF NOT EXISTS config (Clave TEXT PRIMARY KEY, Valor TEXT NOT NULL)")
+            con.execute("INSERT OR IGNORE INTO config VALUES ('celular_nequi', '3000000000')")
+
+    @contextlib.contextmanager
+    def _transaccion(self, escritura=True):
+        con = sqlite3.connect(self.ruta, timeout=30)
+        try:
+            con.execute("PRAGMA journal_mode=WAL")
+            # Las escrituras toman el candado desde el inicio para no pisarse entre sesiones
+            if escritura: con.execute("BEGIN IMMEDIATE")
+            yield con
+            con.commit()
+        except:
+            con.rollback()
+            raise
+        finally: con.close()
+
+    def vacio(self):
+        with self._transaccion(escritura=False) as con:
+            pedidos = con.execute("SELECT COUNT(*) FROM pedidos").fetchone()[0]
+            inventario = con.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'inventario'").fetchone()[0]
+        return pedidos == 0 and inventario == 0
+
+    def leer_inventario(self):
+        with self._transaccion(escritura=False) as con:
+            existe = con.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'inventario'").fetchone()[0]
+            if not existe: return pd.DataFrame(columns=["Grado", "Area", "Libro", "Costo", "Precio Venta"])
+            return pd.read_sql_query("SELECT * FROM inventario", con)
+
+    def guardar_inventario(self, df):
+        with self._transaccion() as con:
+            df.to_sql("inventario", con, if_exists="replace", index=False)
+
+    def leer_pedidos(self):
+        cols = ", ".join(f'"{c}"' for c in COLUMNAS_ESTRICTAS)
+        with self._transaccion(escritura=False) as con:
+            return pd.read_sql_query(f"SELECT {cols} FROM pedidos ORDER BY orden", con)
+
+    def cambios_pedidos(self, previo):
+        # Releer la tabla local cuesta poco: siempre lectura completa
+        return None
+
+    def _fila(self, registro):
+        valores = [valor_celda(registro.get(c, "")) for c in COLUMNAS_ESTRICTAS]
+        return [clave_id(registro['ID_Pedido']), limpiar_numero(registro.get('Celular', ""))] + valores
+
+    def guardar_cambios(self, cambios):
+        cols = ", ".join(f'"{c}"' for c in COLUMNAS_ESTRICTAS)
+        marcas = ", ".join("?" * (len(COLUMNAS_ESTRICTAS) + 2))
+        with self._transaccion() as con:
+            for cambio in cambios:
+                clave = clave_id(cambio['id'])
+                campos = {c: v for c, v in cambio.get('campos', {}).items() if c in COLUMNAS_ESTRICTAS}
+                existe = con.execute("SELECT 1 FROM pedidos WHERE clave = ?", (clave,)).fetchone()
+                if cambio['tipo'] == 'eliminar':
+                    con.execute("DELETE FROM pedidos WHERE clave = ?", (clave,))
+                elif existe:
+                    if 'Celular' in campos: campos_sql = dict(campos, celular_limpio=limpiar_numero(campos['Celular']))
+                    else: campos_sql = campos
+                    asignaciones = ", ".join(f'"{c}" = ?' for c in campos_sql)
+                    if asignaciones:
+                        con.execute(f"UPDATE pedidos SET {asignaciones} WHERE clave = ?",
+                                    [valor_celda(v) for v in campos_sql.values()] + [clave])
+                elif cambio['tipo'] == 'insertar' or len(campos) == len(COLUMNAS_ESTRICTAS):
+                    registro = dict(campos, ID_Pedido=cambio['id'])
+                    con.execute(f"INSERT INTO pedidos (clave, celular_limpio, {cols}) VALUES ({marcas})", self._fila(registro))
+
+    def reescribir_pedidos(self, df):
+        cols = ", ".join(f'"{c}"' for c in COLUMNAS_ESTRICTAS)
+        marcas = ", ".join("?" * (len(COLUMNAS_ESTRICTAS) + 2))
+        filas = [self._fila(r) for r in df[COLUMNAS_ESTRICTAS].to_dict('records')]
+        with self._transaccion() as con:
+            con.execute("DELETE FROM pedidos")
+            con.executemany(f"INSERT OR REPLACE INTO pedidos (clave, celular_limpio, {cols}) VALUES ({marcas})", filas)
+
+    def leer_config(self):
+        with self._transaccion(escritura=False) as con:
+            return pd.read_sql_query("SELECT Clave, Valor FROM config", con).astype(str)
+
+    def guardar_config(self, df_conf):
+        with self._transaccion() as con:
+            con.executemany("INSERT OR REPLACE INTO config VALUES (?, ?)", df_conf[["Clave", "Valor"]].astype(str).values.tolist())
+
+    def temporadas_archivadas(self):
+        with self._transaccion(escritura=False) as con:
+            return [t for (t,) in con.execute("SELECT DISTINCT temporada FROM pedidos_archivo ORDER BY temporada")]
+
+    def leer_archivo(self):
+        cols = ", ".join(f'"{c}"' for c in COLUMNAS_ESTRICTAS)
+        with self._transaccion(escritura=False) as con:
+            return pd.read_sql_query(f"SELECT {cols}, temporada AS Temporada FROM pedidos_archivo ORDER BY rowid", con)
+
+    def archivar_pedidos(self, temporada, df):
+        cols = ", ".join(f'"{c}"' for c in COLUMNAS_ESTRICTAS)
+        marcas = ", ".join("?" * (len(COLUMNAS_ESTRICTAS) + 3))
+        filas = [[temporada] + self._fila(r) for r in df[COLUMNAS_ESTRICTAS].to_dict('records')]
+        with self._transaccion() as con:
+            con.executemany(f"INSERT OR REPLACE INTO pedidos_archivo (temporada, clave, celular_limpio, {cols}) VALUES ({marcas})", filas)
+
+    def siguiente_id(self):
+        # BEGIN IMMEDIATE serializa la reserva entre sesiones y procesos
+        with self._transaccion() as con:
+            fila = con.execute("SELECT Valor FROM config WHERE Clave = ?", (CLAVE_SECUENCIA,)).fetchone()
+            if fila and str(fila[0]).isdigit(): ultimo = int(fila[0])
+            else:
+                ultimo = con.execute("""SELECT COALESCE(MAX(CAST(clave AS INTEGER)), 0) FROM pedidos
+                                        WHERE clave != '' AND clave NOT GLOB '*[^0-9]*'""").fetchone()[0]
+            con.execute("INSERT OR REPLACE INTO config VALUES (?, ?)", (CLAVE_SECUENCIA, str(ultimo + 1)))
+        return f"{ultimo + 1:04d}"
+
+class AlmacenEspejo:
+    """Lee del almacén principal y replica cada escritura en un espejo (normalmente Sheets).
+
+    Un fallo del espejo no anula el guardado: queda registrado en el log.
+    """
+    def __init__(self, principal, espejo):
+        self.principal = principal
+        self.espejo = espejo
+        if principal.vacio():
+            # Primer arranque: copiamos el estado actual del espejo
+            principal.guardar_inventario(espejo.leer_inventario())
+            principal.reescribir_pedidos(normalizar_pedidos(espejo.leer_pedidos()))
+            principal.guardar_config(espejo.leer_config())
+            archivo = espejo.leer_archivo()
+            for temporada, grupo in archivo.groupby('Temporada'): principal.archivar_pedidos(str(temporada), grupo)
+
+    def _replicar(self, metodo, *args):
+        try: getattr(self.espejo, metodo)(*args)
+        except Exception as e: log.warning("No se pudo replicar %s en el espejo: %s", metodo, e)
+
+    def leer_inventario(self): return self.principal.leer_inventario()
+    def leer_pedidos(self): return self.principal.leer_pedidos()
+    def cambios_pedidos(self, previo): return self.principal.cambios_pedidos(previo)
+    def leer_config(self): return self.principal.leer_config()
+    def leer_archivo(self): return self.principal.leer_archivo()
+    def temporadas_archivadas(self): return self.principal.temporadas_archivadas()
+
+    def guardar_inventario(self, df):
+        self.principal.guardar_inventario(df)
+        self._replicar("guardar_inventario", df)
+
+    def guardar_cambios(self, cambios):
+        self.principal.guardar_cambios(cambios)
+        self._replicar("guardar_cambios", cambios)
+
+    def reescribir_pedidos(self, df):
+        self.principal.reescribir_pedidos(df)
+        self._replicar("reescribir_pedidos", df)
+
+    def guardar_config(self, df_conf):
+        self.principal.guardar_config(df_conf)
+        self._replicar("guardar_config", df_conf)
+
+    def archivar_pedidos(self, temporada, df):
+        self.principal.archivar_pedidos(temporada, df)
+        self._replicar("archivar_pedidos", temporada, df)
+
+    def siguiente_id(self):
+        # El principal reparte los IDs; el espejo solo guarda el último para poder relevarlo.
+        # Sheets lo toma como base al crear su hoja Reservas: si ya existe, hay que borrarla antes.
+        nid = self.principal.siguiente_id()
+        self._replicar("guardar_config", pd.DataFrame([[CLAVE_SECUENCIA, str(int(nid))]], columns=["Clave", "Valor"]))
+        return nid
+
+@st.cache_resource
+def obtener_almacen():
+    # ALMACEN: "sheets" (por defecto), "sqlite" o "sqlite+sheets" (SQLite principal con Sheets de espejo)
+    if ALMACEN == "sqlite": return AlmacenSQLite(SQLITE_RUTA)
+    conexion = conectar_sheets()
+    if not conexion: return None
+    sheets = AlmacenSheets(conexion)
+    if ALMACEN == "sqlite+sheets":
+        try: return AlmacenEspejo(AlmacenSQLite(SQLITE_RUTA), sheets)
+        except Exception as e:
+            st.error(f"Error preparando SQLite, se usa solo Google Sheets: {e}")
+    return sheets
+
+def leer_almacen(que, lectura):
+    # Cualquier fallo de lectura sale como ErrorAlmacen: un 429 no puede parecer una hoja vacía
+    almacen = obtener_almacen()
+    if not almacen: return None
+    try: return lectura(almacen)
+    except ErrorAlmacen: raise
+    except Exception as e: raise ErrorAlmacen(f"No se pudo leer {que}: {e}") from e
+
+# --- GESTIÓN DE CONFIGURACIÓN (NEQUI) ---
+# Claves conocidas de Config: tipo y valor por defecto
+CONFIG_CLAVES = {
+    "celular_nequi": (str, "3000000000"),
+}
+
+def _leer_config():
+    return leer_almacen("la configuración", lambda almacen: almacen.leer_config())
+
+def config_valores():
+    # Dict clave -> valor de la hoja Config; se relee a lo sumo una vez por TTL en todo el proceso
+    cache = obtener_cache()
+    df_conf = cache.obtener("Config", _leer_config, copia=False)
+    if df_conf is None or 'Clave' not in df_conf.columns: return {}
+    def construir():
+        df_conf = cache.obtener("Config", _leer_config, copia=False)
+        return dict(zip(df_conf['Clave'], df_conf['Valor']))
+    return cache.derivado("config", ["Config"], construir)
+
+def leer_config_valor(clave):
+    tipo, defecto = CONFIG_CLAVES.get(clave, (str, None))
+    valor = config_valores().get(clave)
+    if valor is None or valor == "": return defecto
+    try: return tipo(valor)
+    except: return defecto
+
+def _poner_config(df_conf, clave, valor):
+    if 'Clave' not in df_conf.columns: df_conf = pd.DataFrame(columns=["Clave", "Valor"])
+    if (df_conf['Clave'] == clave).any(): df_conf.loc[df_conf['Clave'] == clave, 'Valor'] = valor
+    else: df_conf = pd.concat([df_conf, pd.DataFrame([[clave, valor]], columns=["Clave", "Valor"])], ignore_index=True)
+    return df_conf
+
+def guardar_config_valor(clave, valor):
+    # Solo se escribe la fila de la clave; la caché se corrige en el acto para todas las sesiones
+    almacen = obtener_almacen()
+    if not almacen: return False
+    try:
+        valor = str(valor)
+        almacen.guardar_config(pd.DataFrame([[clave, valor]], columns=["Clave", "Valor"]))
+        obtener_cache().modificar("Config", lambda df: _poner_config(df, clave, valor))
+        return True
+    except: return False
+
+def obtener_celular_nequi():
+    if not obtener_almacen(): return "No configurado"
+    return leer_config_valor("celular_nequi")
+
+def guardar_celular_nequi(nuevo_numero):
+    return guardar_config_valor("celular_nequi", nuevo_numero)
+
 # --- CRUD DATOS ---
+# Columnas con pocos valores distintos: en memoria se guardan como categorías
+CATEGORIAS_INVENTARIO = ['Grado', 'Area']
+
+def normalizar_inventario(df):
+    cols = ['Grado', 'Area', 'Libro']
+    for col in cols: 
+        if col in df.columns: df[col] = df[col].astype(str).str.strip()
+    for col in CATEGORIAS_INVENTARIO:
+        if col in df.columns: df[col] = df[col].astype("category")
+    
+    if 'Precio Venta' in df.columns: df['Precio Venta'] = limpiar_moneda_serie(df['Precio Venta'])
+    else: df['Precio Venta'] = 0.0
+    if 'Costo' in df.columns: df['Costo'] = limpiar_moneda_serie(df['Costo'])
+    else: df['Costo'] = 0.0   
+    return df
+
+def _leer_inventario():
+    return leer_almacen("el inventario", lambda almacen: normalizar_inventario(almacen.leer_inventario()))
+
 def cargar_inventario():
-    client = conectar_sheets()
-    if not client: return pd.DataFrame()
-    try:
-        sh = client.open_by_key(SHEET_ID)
-        wk = sh.worksheet("Inventario")
-        data = wk.get_all_records()
-        if not data: return pd.DataFrame(columns=["Grado", "Area", "Libro", "Costo", "Precio Venta"])
-        df = pd.DataFrame(data)
-        cols = ['Grado', 'Area', 'Libro']
-        for col in cols: 
-            if col in df.columns: df[col] = df[col].astype(str).str.strip()
-        
-        if 'Precio Venta' in df.columns: df['Precio Venta'] = df['Precio Venta'].apply(limpiar_moneda)
-        else: df['Precio Venta'] = 0.0
-        if 'Costo' in df.columns: df['Costo'] = df['Costo'].apply(limpiar_moneda)
-        else: df['Costo'] = 0.0   
-        return df
-    except: return pd.DataFrame()
+    df = obtener_cache().obtener("Inventario", _leer_inventario)
+    return df if df is not None else pd.DataFrame()
+
+def inventario_compartido():
+    # Inventario compartido por todas las sesiones: solo lectura
+    df = obtener_cache().obtener("Inventario", _leer_inventario, copia=False)
+    return df if df is not None else pd.DataFrame()
 
 def guardar_inventario(df):
-    client = conectar_sheets()
-    if not client: return
+    almacen = obtener_almacen()
+    if not almacen: return False
     try:
-        sh = client.open_by_key(SHEET_ID)
-        wk = sh.worksheet("Inventario")
-        df['Costo'] = df['Costo'].apply(limpiar_moneda)
-        df['Precio Venta'] = df['Precio Venta'].apply(limpiar_moneda)
+        df['Costo'] = limpiar_moneda_serie(df['Costo'])
+        df['Precio Venta'] = limpiar_moneda_serie(df['Precio Venta'])
         df['Ganancia'] = df['Precio Venta'] - df['Costo']
-        wk.clear()
-        wk.update([df.columns.values.tolist()] + df.values.tolist())
-        st.cache_data.clear()
-    except: pass
+        almacen.guardar_inventario(df)
+        obtener_cache().poner("Inventario", normalizar_inventario(df.copy()))
+        return True
+    except Exception as e:
+        # Cuota, red o datos inválidos: se avisa y la próxima lectura muestra lo que quedó en la hoja
+        obtener_cache().invalidar("Inventario")
+        st.error(f"Error guardando inventario: {e}")
+        return False
 
-def cargar_pedidos():
-    client = conectar_sheets()
-    if not client: return pd.DataFrame(columns=COLUMNAS_ESTRICTAS)
+def normalizar_pedidos(df):
+    # BLINDAJE: Asegurar columnas y orden
+    for col in COLUMNAS_ESTRICTAS:
+        if col not in df.columns: df[col] = ""
+    df = df[COLUMNAS_ESTRICTAS]
     
+    if 'ID_Pedido' in df.columns: df['ID_Pedido'] = df['ID_Pedido'].astype(str)
+    # Montos numéricos, fechas como datetime y el estado como categoría desde la carga:
+    # el resto de la app no vuelve a limpiar texto y a la hoja se vuelve con valor_celda
+    for col in COLUMNAS_MONEDA: df[col] = limpiar_moneda_serie(df[col])
+    for col in COLUMNAS_FECHA: df[col] = fechas_serie(df[col])
+    df['Estado'] = df['Estado'].fillna("").astype(str).astype("category")
+    df['Celular'] = df['Celular'].map(valor_celda)
+    return df.reset_index(drop=True)
+
+def _leer_pedidos():
+    return leer_almacen("los pedidos", lambda almacen: normalizar_pedidos(almacen.leer_pedidos()))
+
+def _sincronizar_pedidos(previo):
+    # Pone al día la copia vencida con solo las filas que cambiaron; None = lectura completa
+    cambios = leer_almacen("los cambios de pedidos", lambda almacen: almacen.cambios_pedidos(previo))
+    if cambios is None: return None
+    return (aplicar_cambios_df(previo, cambios) if cambios else previo), cambios
+
+def pedidos_compartidos():
+    # DataFrame de pedidos compartido por todas las sesiones: solo lectura
+    return obtener_cache().obtener("Pedidos", _leer_pedidos, copia=False, refrescar=_sincronizar_pedidos)
+
+def cargar_pedidos():
+    df = obtener_cache().obtener("Pedidos", _leer_pedidos, refrescar=_sincronizar_pedidos)
+    return df if df is not None else pd.DataFrame(columns=COLUMNAS_ESTRICTAS)
+
+def _volcar_valores(df, claves, valores):
+    # Las actualizaciones acumuladas (columna -> {clave: valor}) se escriben con un solo isin/map por columna
+    for col, por_clave in valores.items():
+        mask = claves.isin(list(por_clave))
+        nuevos = claves[mask].map(por_clave)
+        # Montos y fechas se convierten antes de escribirlos: la columna conserva su tipo
+        if col in COLUMNAS_MONEDA and pd.api.types.is_float_dtype(df[col]): nuevos = limpiar_moneda_serie(nuevos.astype(object))
+        elif col in COLUMNAS_FECHA and pd.api.types.is_datetime64_any_dtype(df[col]): nuevos = fechas_serie(nuevos.astype(object))
+        elif df[col].dtype != object: df[col] = df[col].astype(object)
+        df.loc[mask, col] = nuevos
+    valores.clear()
+    return df
+
+def aplicar_cambios_df(df, cambios):
+    # Reproduce sobre el DataFrame en memoria lo que guardar_cambios_pedidos hizo en el almacén
+    df = df.copy(deep=False)
+    claves = df['ID_Pedido'].map(clave_id)
+    existentes = set(claves)
+    nuevas, borrar, valores = [], set(), {}
+    for i, cambio in enumerate(cambios):
+        clave = clave_id(cambio['id'])
+        if cambio['tipo'] == 'eliminar':
+            # Las eliminaciones seguidas (p. ej. al archivar) se aplican juntas con un solo isin
+            borrar.add(clave)
+            if i + 1 < len(cambios) and cambios[i + 1]['tipo'] == 'eliminar': continue
+            df = _volcar_valores(df, claves, valores)
+            mask = claves.isin(borrar)
+            df, claves = df[~mask], claves[~mask]
+            existentes -= borrar
+            borrar = set()
+            continue
+        campos = {c: v for c, v in cambio.get('campos', {}).items() if c in COLUMNAS_ESTRICTAS}
+        if clave in existentes:
+            for col, val in campos.items(): valores.setdefault(col, {})[clave] = val
+        elif cambio['tipo'] == 'insertar' or len(campos) == len(COLUMNAS_ESTRICTAS):
+            registro = dict(campos, ID_Pedido=str(cambio['id']))
+            nuevas.append({c: registro.get(c, "") for c in COLUMNAS_ESTRICTAS})
+    df = _volcar_valores(df, claves, valores)
+    if nuevas: df = pd.concat([df, normalizar_pedidos(pd.DataFrame(nuevas))], ignore_index=True)
+    return normalizar_pedidos(df)
+
+def cambios_edicion_rapida(df, editado, fecha):
+    """Compara la tabla editada con los pedidos y arma cambios solo con las celdas distintas."""
+    cols = ["Estado", "Abonado", "Saldo"]
+    comp = editado[["ID_Pedido"] + cols].merge(
+        df[["ID_Pedido"] + cols].drop_duplicates("ID_Pedido"), on="ID_Pedido", suffixes=("", "_orig"))
+    distinto = pd.DataFrame({"Estado": comp["Estado"].fillna("").astype(str) != comp["Estado_orig"].fillna("").astype(str)})
+    for col in ["Abonado", "Saldo"]:
+        comp[col] = limpiar_moneda_serie(comp[col])
+        distinto[col] = comp[col] != comp[col + "_orig"]
+    cambios = []
+    for i in distinto.index[distinto.any(axis=1)]:
+        campos = {c: comp.at[i, c] for c in cols if distinto.at[i, c]}
+        campos["Ultima_Modificacion"] = fecha
+        cambios.append({"tipo": "actualizar", "id": comp.at[i, "ID_Pedido"], "campos": campos})
+    return cambios
+
+def coalescer_cambios(cambios):
+    # Funde los cambios de un lote que tocan el mismo pedido, respetando el orden de llegada
+    salida, ultimo = [], {}
+    for cambio in cambios:
+        clave = clave_id(cambio['id'])
+        campos = dict(cambio.get('campos', {}))
+        previo = ultimo.get(clave)
+        if previo is None: nuevo = dict(cambio, campos=campos)
+        elif cambio['tipo'] == 'eliminar':
+            salida = [c for c in salida if c is not previo]
+            nuevo = dict(cambio, campos={})
+        elif previo['tipo'] == 'eliminar':
+            # Borrar y volver a crear = reemplazar la fila completa
+            if cambio['tipo'] != 'insertar': continue
+            salida = [c for c in salida if c is not previo]
+            campos.setdefault('ID_Pedido', cambio['id'])
+            nuevo = dict(cambio, campos={c: campos.get(c, "") for c in COLUMNAS_ESTRICTAS})
+        else:
+            previo['campos'].update(campos)
+            if cambio['tipo'] == 'insertar': previo['tipo'] = 'insertar'
+            continue
+        salida.append(nuevo)
+        ultimo[clave] = nuevo
+    return salida
+
+def compactar_pedidos_db():
+    """Reescritura completa de Pedidos: solo para compactar/reparar, no para guardar pedidos.
+
+    Corre como trabajo del hilo escritor: la lectura fresca y la reescritura van entre dos
+    lotes, así que ningún guardado de este proceso queda en medio y se pierde.
+    Las filas repetidas idénticas se dejan una sola vez; los IDs que siguen repetidos con
+    datos distintos se devuelven para corregirlos a mano (los guardados sobre ellos se rechazan).
+    Devuelve (pedidos, ids_repetidos), con 0 pedidos si no se leyó ninguno, o None si falló.
+    """
+    almacen = obtener_almacen()
+    cola = obtener_cola_escritura()
+    if not almacen or not cola: return None
+    def compactar():
+        # normalizar_pedidos fuerza el orden estricto de columnas antes de guardar
+        df = normalizar_pedidos(almacen.leer_pedidos())
+        if df.empty: return 0, []
+        df = df.drop_duplicates().reset_index(drop=True)
+        almacen.reescribir_pedidos(df)
+        claves = df['ID_Pedido'].map(clave_id)
+        return len(df), sorted(df.loc[claves.duplicated(keep=False), 'ID_Pedido'].unique())
+    try: return cola.trabajo(compactar).result(timeout=120)
+    except Exception as e:
+        st.error(f"Error compactando pedidos: {e}")
+        return None
+    finally: obtener_cache().invalidar("Pedidos")
+
+def guardar_cambios_pedidos(cambios):
+    """Aplica una lista de cambios sobre Pedidos tocando solo las filas afectadas.
+
+    Cada cambio es un dict {"tipo": "insertar" | "actualizar" | "eliminar", "id": ID_Pedido, "campos": {...}}.
+    """
+    if not cambios: return True
+    cola = obtener_cola_escritura()
+    if not cola: return False
     try:
-        sh = client.open_by_key(SHEET_ID)
-        wk = sh.worksheet("Pedidos")
-        data = wk.get_all_records()
-        
-        if not data: return pd.DataFrame(columns=COLUMNAS_ESTRICTAS)
-        
-        df = pd.DataFrame(data)
-        
-        # BLINDAJE: Asegurar columnas y orden
-        for col in COLUMNAS_ESTRICTAS:
-            if col not in df.columns: df[col] = ""
-        df = df[COLUMNAS_ESTRICTAS]
-        
-        if 'ID_Pedido' in df.columns: df['ID_Pedido'] = df['ID_Pedido'].astype(str)
+        cola.enviar(cambios).result(timeout=60)
+        return True
+    except EsperaAgotada:
+        # El cambio sigue en la cola y se va a escribir: no es un error, y repetirlo no debe duplicar nada
+        st.warning("⏳ El guardado sigue en proceso. Espera un momento y revisa el pedido antes de enviarlo otra vez.")
+        return False
+    except Exception as e:
+        st.error(f"Error guardando pedido: {e}")
+        return False
+
+def reservar_id_pedido():
+    # El ID sale del contador del almacén, no del máximo de un DataFrame que puede estar viejo
+    almacen = obtener_almacen()
+    if not almacen: return None
+    try: return almacen.siguiente_id()
+    except Exception as e:
+        st.error(f"No se pudo asignar número de pedido: {e}")
+        return None
+
+def id_formulario(clave):
+    # El ID reservado queda en la sesión hasta guardar: si el mismo formulario se envía de nuevo
+    # (p. ej. tras una espera agotada) el "insertar" cae sobre el mismo pedido y no crea otro
+    estado = f"id_reservado_{clave}"
+    if not st.session_state.get(estado): st.session_state[estado] = reservar_id_pedido()
+    return st.session_state[estado]
+
+def soltar_id_formulario(clave):
+    st.session_state.pop(f"id_reservado_{clave}", None)
+
+def insertar_pedido_db(registro):
+    return guardar_cambios_pedidos([{"tipo": "insertar", "id": registro['ID_Pedido'], "campos": registro}])
+
+def actualizar_pedido_db(id_pedido, campos):
+    return guardar_cambios_pedidos([{"tipo": "actualizar", "id": id_pedido, "campos": campos}])
+
+def eliminar_pedido_db(id_pedido):
+    return guardar_cambios_pedidos([{"tipo": "eliminar", "id": id_pedido}])
+
+# --- TEMPORADAS Y ARCHIVO ---
+def temporada_pedidos(df):
+    # La temporada es el año de creación del pedido ("2025")
+    return fechas_serie(df['Fecha_Creacion']).dt.strftime("%Y").fillna("")
+
+def _leer_archivo():
+    def leer(almacen):
+        df = almacen.leer_archivo()
+        temporadas = df['Temporada'].astype(str).values
+        df = normalizar_pedidos(df)
+        df['Temporada'] = temporadas
         return df
-    except: 
-        return pd.DataFrame(columns=COLUMNAS_ESTRICTAS)
+    return leer_almacen("el archivo de temporadas", leer)
+
+def cargar_archivo():
+    df = obtener_cache().obtener("Archivo", _leer_archivo, copia=False)
+    return df if df is not None else pd.DataFrame(columns=COLUMNAS_ESTRICTAS + ["Temporada"])
 
-def guardar_pedido_db(df):
-    client = conectar_sheets()
-    if not client: return
+def temporadas_archivadas():
+    # Solo la lista de hojas/temporadas, sin leer los pedidos archivados.
+    # Es un extra del selector de reportes: si la cuota está justa, se omite.
+    leer = lambda: leer_almacen("las temporadas", lambda almacen: pd.DataFrame({"Temporada": almacen.temporadas_archivadas()}))
     try:
-        # Forzar orden estricto antes de guardar
-        for col in COLUMNAS_ESTRICTAS:
-            if col not in df.columns: df[col] = ""
-        df = df[COLUMNAS_ESTRICTAS]
-        
-        sh = client.open_by_key(SHEET_ID)
-        wk = sh.worksheet("Pedidos")
-        df = df.astype(str)
-        wk.clear()
-        wk.update([df.columns.values.tolist()] + df.values.tolist())
-    except Exception as e: st.error(f"Error guardando pedido: {e}")
+        with obtener_limitador().no_critica(): df = obtener_cache().obtener("Temporadas", leer, copia=False)
+    except ErrorAlmacen: return []
+    return [] if df is None else list(df['Temporada'])
+
+def buscar_en_archivo(celular=None, id_pedido=None):
+    # Respaldo de las búsquedas: solo se consulta cuando la hoja activa no tiene el pedido.
+    # Es una lectura no crítica: cerca de la cuota sale CuotaAgotada en vez de gastar cupo,
+    # y la búsqueda sigue como "sin resultados" con un aviso en lugar de cortar la página.
+    try:
+        with obtener_limitador().no_critica(): arch = cargar_archivo()
+    except CuotaAgotada:
+        st.info("Por ahora no se pudo revisar el archivo de temporadas anteriores; intenta de nuevo en un minuto.")
+        return pd.DataFrame(columns=COLUMNAS_ESTRICTAS + ["Temporada"])
+    if arch.empty: return arch
+    if id_pedido is not None: mask = arch['ID_Pedido'].map(clave_id) == clave_id(id_pedido)
+    else:
+        clean = limpiar_numero(celular)
+        if not clean: return arch.iloc[0:0]
+        mask = arch['Celular'].map(limpiar_numero) == clean
+    return arch[mask].reset_index(drop=True)
+
+def archivar_temporada_db(temporada):
+    """Pasa los pedidos de una temporada cerrada al archivo y los quita de la hoja activa.
+
+    Devuelve cuántos pedidos se movieron. El borrado va por la cola de escritura,
+    así que los guardados que lleguen mientras tanto no se pierden.
+    """
+    almacen = obtener_almacen()
+    if not almacen: return 0
+    cache = obtener_cache()
+    cache.invalidar("Pedidos")
+    df = cargar_pedidos()
+    mover = df[temporada_pedidos(df) == temporada]
+    if mover.empty: return 0
+    try: almacen.archivar_pedidos(temporada, mover)
+    except Exception as e:
+        st.error(f"Error archivando la temporada {temporada}: {e}")
+        return 0
+    finally:
+        cache.invalidar("Archivo")
+        cache.invalidar("Temporadas")
+    if not guardar_cambios_pedidos([{"tipo": "eliminar", "id": pid} for pid in mover['ID_Pedido']]): return 0
+    return len(mover)
+
+# --- COLA DE ESCRITURA DE PEDIDOS ---
+class ColaEscritura:
+    """Un solo hilo escritor por proceso para todos los guardados de Pedidos.
+
+    Cada sesión encola su lista de cambios y espera su Future. El hilo junta lo que
+    llegue durante la ventana y lo manda al almacén en un único guardar_cambios
+    (un batch_update y un append_rows en Sheets), así que dos sesiones nunca
+    calculan filas sobre una hoja que la otra está modificando. Las operaciones que
+    tocan toda la hoja (compactar) se encolan con `trabajo` y corren solas, entre dos lotes.
+    """
+    def __init__(self, almacen, cache, ventana_ms):
+        self.almacen = almacen
+        self.cache = cache
+        self.ventana = ventana_ms / 1000
+        self._cola = queue.Queue()
+        self._pendiente = None
+        self._hilo = threading.Thread(target=self._escribir, name="escritor_pedidos", daemon=True)
+        self._hilo.start()
+
+    def enviar(self, cambios):
+        futuro = Future()
+        self._cola.put((cambios, futuro))
+        return futuro
+
+    def trabajo(self, funcion):
+        # `funcion()` corre en el hilo escritor; el Future devuelve su resultado
+        futuro = Future()
+        self._cola.put((funcion, futuro))
+        return futuro
+
+    def _tomar_lote(self):
+        lote = [self._pendiente or self._cola.get()]
+        self._pendiente = None
+        if callable(lote[0][0]): return lote
+        limite = time.monotonic() + self.ventana
+        while True:
+            resta = limite - time.monotonic()
+            if resta <= 0: break
+            try: envio = self._cola.get(timeout=resta)
+            except queue.Empty: break
+            # Un trabajo cierra el lote y corre solo en la vuelta siguiente
+            if callable(envio[0]):
+                self._pendiente = envio
+                break
+            lote.append(envio)
+        return lote
+
+    def _guardar(self, cambios):
+        self.almacen.guardar_cambios(cambios)
+        self.cache.modificar("Pedidos", lambda df: aplicar_cambios_df(df, cambios), cambios)
+
+    def _escribir(self):
+        while True:
+            lote = self._tomar_lote()
+            if callable(lote[0][0]):
+                funcion, futuro = lote[0]
+                try: futuro.set_result(funcion())
+                except Exception as e: futuro.set_exception(e)
+                continue
+            try:
+                self._guardar(coalescer_cambios([c for cambios, _ in lote for c in cambios]))
+                for _, futuro in lote: futuro.set_result(True)
+                continue
+            except Exception as e:
+                if len(lote) == 1:
+                    self.cache.invalidar("Pedidos")
+                    lote[0][1].set_exception(e)
+                    continue
+                log.warning("Falló un lote de %d guardados, se reintenta uno por uno: %s", len(lote), e)
+            # Uno por uno, para que un envío con problemas no arrastre a los demás
+            for cambios, futuro in lote:
+                try:
+                    self._guardar(cambios)
+                    futuro.set_result(True)
+                except Exception as e:
+                    self.cache.invalidar("Pedidos")
+                    futuro.set_exception(e)
+
+@st.cache_resource
+def obtener_cola_escritura():
+    almacen = obtener_almacen()
+    if not almacen: return None
+    return ColaEscritura(almacen, obtener_cache(), ESCRITURA_VENTANA_MS)
+
+# --- ÍNDICE DE CELULARES ---
+class IndiceCelulares:
+    """Índice celular normalizado -> pedidos para las búsquedas de clientes.
+
+    Se construye una vez por versión de Pedidos y los guardados lo actualizan con
+    `aplicar(cambios)`, así que una búsqueda cuesta lo que sus coincidencias.
+    """
+    def __init__(self, df):
+        self._lock = threading.Lock()
+        self._siguiente = 0
+        self._por_celular = {}   # celular limpio -> {orden: registro}
+        self._por_id = {}        # clave_id -> [orden, ...]
+        self._registros = {}     # orden -> (celular limpio, registro)
+        for registro in df[COLUMNAS_ESTRICTAS].to_dict('records'): self._agregar(registro)
+
+    def _poner(self, orden, registro):
+        for col in COLUMNAS_MONEDA:
+            if col in registro: registro[col] = limpiar_moneda(registro[col])
+        # Las fechas que llegan como texto en un guardado se guardan como las de la carga
+        for col in COLUMNAS_FECHA:
+            if isinstance(registro.get(col), str): registro[col] = fechas_serie(pd.Series([registro[col]], dtype=object))[0]
+        cel = limpiar_numero(registro.get('Celular', ''))
+        anterior = self._registros.get(orden)
+        if anterior and anterior[0] != cel:
+            self._por_celular[anterior[0]].pop(orden, None)
+            if not self._por_celular[anterior[0]]: del self._por_celular[anterior[0]]
+        self._registros[orden] = (cel, registro)
+        self._por_celular.setdefault(cel, {})[orden] = registro
+
+    def _agregar(self, registro):
+        orden = self._siguiente
+        self._siguiente += 1
+        self._poner(orden, registro)
+        self._por_id.setdefault(clave_id(registro['ID_Pedido']), []).append(orden)
+
+    def aplicar(self, cambios):
+        # Mismas reglas que aplicar_cambios_df, pero solo sobre los pedidos tocados
+        with self._lock:
+            for cambio in cambios:
+                clave = clave_id(cambio['id'])
+                campos = {c: v for c, v in cambio.get('campos', {}).items() if c in COLUMNAS_ESTRICTAS}
+                ordenes = self._por_id.get(clave, [])
+                if cambio['tipo'] == 'eliminar':
+                    for orden in ordenes:
+                        cel, _ = self._registros.pop(orden)
+                        self._por_celular[cel].pop(orden, None)
+                        if not self._por_celular[cel]: del self._por_celular[cel]
+                    self._por_id.pop(clave, None)
+                elif ordenes:
+                    for orden in ordenes: self._poner(orden, dict(self._registros[orden][1], **campos))
+                elif cambio['tipo'] == 'insertar' or len(campos) == len(COLUMNAS_ESTRICTAS):
+                    registro = dict(campos, ID_Pedido=str(cambio['id']))
+                    self._agregar({c: registro.get(c, "") for c in COLUMNAS_ESTRICTAS})
+        return self
+
+    def buscar(self, celular):
+        clean = limpiar_numero(celular)
+        with self._lock: encontrados = sorted(self._por_celular.get(clean, {}).items()) if clean else []
+        return pd.DataFrame([r for _, r in encontrados], columns=COLUMNAS_ESTRICTAS)
+
+def pedidos_por_celular(celular, archivo=False):
+    # Pedidos de un celular en el orden de la hoja, sin recorrer toda la tabla.
+    # Con archivo=True, si no hay pedidos activos se buscan en temporadas archivadas.
+    cache = obtener_cache()
+    pedidos_compartidos()
+    indice = cache.derivado(
+        "indice_celulares", ["Pedidos"],
+        lambda: IndiceCelulares(pedidos_compartidos()),
+        actualizar=lambda indice, cambios: indice.aplicar(cambios))
+    res = indice.buscar(celular)
+    if res.empty and archivo: return buscar_en_archivo(celular=celular)
+    return res
+
+# --- BÚSQUEDA DE PEDIDOS (PANEL) ---
+class IndiceBusqueda:
+    """Índice de palabras de cliente, celular e ID para los buscadores del panel.
+
+    Las palabras se normalizan con normalizar_clave ("Martínez" -> "martinez") y se guardan
+    ordenadas: un prefijo se resuelve con bisect, así que una búsqueda cuesta lo que sus
+    coincidencias y no lo que mide la tabla. Se construye una vez por versión de Pedidos y
+    los guardados lo actualizan con `aplicar(cambios)`. Cada fila es una entrada propia
+    (numerada en el orden de la hoja), así que un ID repetido no esconde a la otra fila.
+    """
+    def __init__(self, df):
+        self._lock = threading.Lock()
+        self._siguiente = 0
+        self._pedidos = {}     # fila -> (etiqueta "ID - Cliente", palabras, registro)
+        self._por_id = {}      # clave_id -> [fila, ...]
+        self._indice = {}      # palabra -> {fila, ...}
+        self._ordenadas = None # palabras del índice en orden, para buscar por prefijo
+        self._etiquetas = None
+        for pid, cliente, celular in df[['ID_Pedido', 'Cliente', 'Celular']].itertuples(index=False, name=None):
+            self._poner(self._nueva_fila(clave_id(pid)), {'ID_Pedido': pid, 'Cliente': cliente, 'Celular': celular})
+        self._ordenadas = sorted(self._indice)
+
+    @staticmethod
+    def _palabras(registro):
+        # Palabras del nombre sin tildes, el celular solo con dígitos y el ID con y sin ceros
+        palabras = set(re.findall(r'\w+', normalizar_clave(registro.get('Cliente', ''))))
+        palabras.add(limpiar_numero(registro.get('Celular', '')))
+        palabras.update({normalizar_clave(registro['ID_Pedido']), clave_id(registro['ID_Pedido'])})
+        palabras.discard("")
+        return palabras
+
+    def _nueva_fila(self, clave):
+        fila = self._siguiente
+        self._siguiente += 1
+        self._por_id.setdefault(clave, []).append(fila)
+        return fila
+
+    def _quitar(self, fila):
+        previo = self._pedidos.pop(fila, None)
+        if not previo: return
+        for palabra in previo[1]:
+            filas = self._indice[palabra]
+            filas.discard(fila)
+            if not filas:
+                del self._indice[palabra]
+                if self._ordenadas is not None: del self._ordenadas[bisect.bisect_left(self._ordenadas, palabra)]
+
+    def _poner(self, fila, registro):
+        self._quitar(fila)
+        palabras = self._palabras(registro)
+        for palabra in palabras:
+            if palabra not in self._indice:
+                self._indice[palabra] = set()
+                if self._ordenadas is not None: bisect.insort(self._ordenadas, palabra)
+            self._indice[palabra].add(fila)
+        self._pedidos[fila] = (f"{registro['ID_Pedido']} - {registro.get('Cliente', '')}", palabras, registro)
+        self._etiquetas = None
+
+    def aplicar(self, cambios):
+        # Mismas reglas que aplicar_cambios_df (un cambio toca todas las filas de su ID);
+        # solo se vuelven a indexar las filas tocadas
+        with self._lock:
+            for cambio in cambios:
+                clave = clave_id(cambio['id'])
+                campos = {c: v for c, v in cambio.get('campos', {}).items() if c in ['ID_Pedido', 'Cliente', 'Celular']}
+                filas = self._por_id.get(clave, [])
+                if cambio['tipo'] == 'eliminar':
+                    for fila in self._por_id.pop(clave, []): self._quitar(fila)
+                    self._etiquetas = None
+                elif filas:
+                    for fila in filas: self._poner(fila, dict(self._pedidos[fila][2], **campos))
+                elif cambio['tipo'] == 'insertar' or len(cambio.get('campos', {})) == len(COLUMNAS_ESTRICTAS):
+                    registro = dict({'Cliente': "", 'Celular': ""}, **campos)
+                    registro['ID_Pedido'] = str(cambio['id'])
+                    self._poner(self._nueva_fila(clave), registro)
+        return self
+
+    def buscar(self, texto, limite=None):
+        """IDs de los pedidos con todas las palabras de `texto` (o palabras que empiezan así), mejores primero.
+
+        Una palabra exacta vale más que un prefijo; a igual puntaje se respeta el orden de la hoja.
+        Un ID repetido en la hoja sale una vez, en el puesto de su mejor fila.
+        """
+        texto = normalizar_clave(texto)
+        # Un número con espacios o guiones ("300 111-2222") se busca entero, como celular o ID
+        terminos = [limpiar_numero(texto)] if re.fullmatch(r'[\d\s().+-]+', texto) else re.findall(r'\w+', texto)
+        if not terminos or not terminos[0]: return []
+        with self._lock:
+            por_termino, exactas = [], []
+            for termino in terminos:
+                filas = set()
+                i = bisect.bisect_left(self._ordenadas, termino)
+                while i < len(self._ordenadas) and self._ordenadas[i].startswith(termino):
+                    filas.update(self._indice[self._ordenadas[i]])
+                    i += 1
+                por_termino.append(filas)
+                exactas.append(self._indice.get(termino, ()))
+            encontrados = set.intersection(*por_termino)
+            # Clave de orden entera: primero más palabras exactas, luego el orden de la hoja
+            tope = self._siguiente
+            orden = {f: f - tope * sum(f in e for e in exactas) for f in encontrados}
+            ids = dict.fromkeys(self._pedidos[f][2]['ID_Pedido'] for f in sorted(encontrados, key=orden.__getitem__))
+            return list(ids)[:limite]
+
+    def etiquetas(self, ids=None):
+        """Opciones "ID - Cliente" de `ids` (en ese orden) o de todos los pedidos en el orden de la hoja."""
+        with self._lock:
+            if ids is not None: return [self._pedidos[f][0] for pid in ids for f in self._por_id.get(clave_id(pid), [])]
+            if self._etiquetas is None: self._etiquetas = [self._pedidos[f][0] for f in sorted(self._pedidos)]
+            return self._etiquetas
+
+def _pedidos_o_vacio():
+    pedidos = pedidos_compartidos()
+    return pedidos if pedidos is not None else pd.DataFrame(columns=COLUMNAS_ESTRICTAS)
+
+def indice_busqueda():
+    # Las entradas se leen antes (la lectura puede subir la versión) y otra vez dentro de construir
+    cache = obtener_cache()
+    pedidos_compartidos()
+    return cache.derivado(
+        "indice_busqueda", ["Pedidos"],
+        lambda: IndiceBusqueda(_pedidos_o_vacio()),
+        actualizar=lambda indice, cambios: indice.aplicar(cambios))
+
+# --- ITEMS DE PEDIDOS (DETALLE PARSEADO) ---
+PATRON_GRADO = re.compile(r'\[(.*?)\]')
+PATRON_AREA = re.compile(r'\((.*?)\)')
+COLUMNAS_ITEMS = ["ID_Pedido", "Pos", "Grado", "Area", "Libro", "Precio", "Explicita"]
+
+def construir_catalogo(inventario):
+    # Por grado: áreas en orden de inventario y búsquedas por nombre de área y de libro
+    catalogo = {}
+    if inventario.empty or 'Grado' not in inventario.columns: return catalogo
+    for grado, inv_g in inventario.groupby('Grado', sort=False, observed=True):
+        areas = list(inv_g['Area'].unique())
+        por_area = {}
+        for a in areas: por_area.setdefault(str(a).strip().lower(), a)
+        catalogo[grado] = {
+            'areas': areas,
+            'por_area': por_area,
+            'area_de_libro': {normalizar_clave(k): v for k, v in zip(inv_g['Libro'], inv_g['Area'])},
+            'precio_de_libro': {normalizar_clave(k): float(v) for k, v in zip(inv_g['Libro'], inv_g['Precio Venta'])},
+        }
+    return catalogo
+
+def parsear_detalle(id_pedido, detalle, catalogo):
+    """Convierte un Detalle "[grado] (area) libro | ..." en filas de COLUMNAS_ITEMS.
+
+    El área se toma del paréntesis si coincide con un área del grado (Explicita=True);
+    si no, se busca el libro en el inventario como en el formato antiguo "[grado] libro".
+    """
+    filas = []
+    for pos, item in enumerate(str(detalle).split(" | ")):
+        m_grado = PATRON_GRADO.search(item)
+        if not m_grado: continue
+        grado = m_grado.group(1)
+        datos = catalogo.get(grado)
+        area, explicita, libro = None, False, None
+        m_area = PATRON_AREA.search(item)
+        if datos and m_area:
+            area = datos['por_area'].get(m_area.group(1).strip().lower())
+            if area is not None:
+                explicita = True
+                libro = item[m_area.end():].strip()
+        raw = item.replace(f"[{grado}]", "").strip()
+        if libro is None: libro = raw
+        if datos and area is None: area = datos['area_de_libro'].get(normalizar_clave(raw))
+        precio = datos['precio_de_libro'].get(normalizar_clave(libro), 0.0) if datos else 0.0
+        filas.append((id_pedido, pos, grado, area, libro, precio, explicita))
+    return filas
+
+@medido("parseo_detalle")
+def construir_items(df_pedidos, inventario, catalogo=None):
+    if catalogo is None: catalogo = construir_catalogo(inventario)
+    filas = []
+    for pid, detalle in zip(df_pedidos['ID_Pedido'], df_pedidos['Detalle']):
+        filas.extend(parsear_detalle(pid, detalle, catalogo))
+    return pd.DataFrame(filas, columns=COLUMNAS_ITEMS)
+
+def _actualizar_items(valor, cambios):
+    # Solo se vuelven a parsear los pedidos cuyo Detalle cambió
+    tabla, catalogo = valor
+    claves = tabla['ID_Pedido'].map(clave_id)
+    ids_originales = dict(zip(claves, tabla['ID_Pedido']))
+    quitar, nuevas = set(), []
+    for cambio in cambios:
+        clave = clave_id(cambio['id'])
+        campos = cambio.get('campos', {})
+        completo = all(c in campos for c in COLUMNAS_ESTRICTAS)
+        if cambio['tipo'] == 'eliminar':
+            quitar.add(clave)
+            nuevas = [f for f in nuevas if clave_id(f[0]) != clave]
+        elif 'Detalle' in campos and (cambio['tipo'] == 'insertar' or completo or clave in ids_originales):
+            quitar.add(clave)
+            nuevas = [f for f in nuevas if clave_id(f[0]) != clave]
+            nuevas.extend(parsear_detalle(ids_originales.get(clave, str(cambio['id'])), campos['Detalle'], catalogo))
+    if not quitar: return valor
+    tabla = tabla[~claves.isin(quitar)]
+    if nuevas: tabla = pd.concat([tabla, pd.DataFrame(nuevas, columns=COLUMNAS_ITEMS)], ignore_index=True)
+    return tabla, catalogo
+
+def catalogo_inventario():
+    cache = obtener_cache()
+    inventario_compartido()
+    return cache.derivado("catalogo", ["Inventario"], lambda: construir_catalogo(inventario_compartido()))
+
+def items_pedidos():
+    """Tabla larga (ID_Pedido, Grado, Area, Libro, Precio...) de todos los pedidos, una vez por versión de datos."""
+    cache = obtener_cache()
+    pedidos_compartidos()
+    catalogo_inventario()
+    def construir():
+        catalogo = catalogo_inventario()
+        return construir_items(_pedidos_o_vacio(), None, catalogo), catalogo
+    tabla, _ = cache.derivado("items_pedidos", ["Pedidos", "Inventario"], construir, actualizar=_actualizar_items)
+    return tabla
+
+# --- AGREGADOS DE VENTAS (TABLERO) ---
+# Pedidos que no cuentan como venta ni como cartera
+ESTADOS_SIN_VENTA = {"Anulado"}
+ESTADO_IMPRESION = "En Impresión"
+
+class AgregadosPedidos:
+    """Ventas y cartera por estado y por grado, y libros por imprimir, ya sumados.
+
+    Se guarda el aporte de cada pedido a cada suma; un guardado resta el aporte anterior
+    de los pedidos que toca y suma el nuevo, así el tablero nunca recorre toda la tabla.
+    """
+    def __init__(self, pedidos, items, catalogo):
+        self._lock = threading.Lock()
+        self.catalogo = catalogo
+        self._registros = {}   # clave_id -> registro del pedido
+        self._items = {}       # clave_id -> [(grado, area, libro, precio), ...]
+        self._aportes = {}     # clave_id -> {(tabla, fila, medida): valor}
+        self._sumas = collections.defaultdict(float)
+        por_pedido = {}
+        for pid, *item in items[['ID_Pedido', 'Grado', 'Area', 'Libro', 'Precio']].itertuples(index=False, name=None):
+            por_pedido.setdefault(clave_id(pid), []).append(tuple(item))
+        for registro in pedidos[COLUMNAS_ESTRICTAS].to_dict('records'):
+            clave = clave_id(registro['ID_Pedido'])
+            self._poner(clave, registro, por_pedido.get(clave, []))
+
+    @staticmethod
+    def _aporte(registro, items):
+        estado = str(registro.get('Estado', '')).strip() or "Sin estado"
+        total, abonado, saldo = (limpiar_moneda(registro.get(c, 0)) for c in COLUMNAS_MONEDA)
+        aporte = collections.Counter({("estado", estado, "Pedidos"): 1, ("estado", estado, "Total"): total,
+                                      ("estado", estado, "Abonado"): abonado, ("estado", estado, "Saldo"): saldo})
+        if estado in ESTADOS_SIN_VENTA: return aporte
+        if not items:
+            aporte[("grado", "Sin detalle", "Pedidos")] += 1
+            aporte[("grado", "Sin detalle", "Saldo")] += saldo
+            return aporte
+        # El saldo del pedido se reparte entre sus grados según el precio de los libros
+        precio_total = sum(item[3] for item in items)
+        for grado in {item[0] for item in items}: aporte[("grado", grado, "Pedidos")] += 1
+        for grado, area, libro, precio in items:
+            peso = precio / precio_total if precio_total else 1 / len(items)
+            aporte[("grado", grado, "Libros")] += 1
+            aporte[("grado", grado, "Ventas")] += precio
+            aporte[("grado", grado, "Saldo")] += saldo * peso
+            if estado == ESTADO_IMPRESION: aporte[("imprimir", (grado, area, libro), "Cantidad")] += 1
+        return aporte
+
+    def _quitar(self, clave):
+        for k, v in self._aportes.pop(clave, {}).items():
+            self._sumas[k] -= v
+            if abs(self._sumas[k]) < 1e-6: del self._sumas[k]
+        self._registros.pop(clave, None)
+        self._items.pop(clave, None)
+
+    def _poner(self, clave, registro, items):
+        self._quitar(clave)
+        aporte = self._aporte(registro, items)
+        for k, v in aporte.items(): self._sumas[k] += v
+        self._registros[clave] = registro
+        self._items[clave] = items
+        self._aportes[clave] = aporte
+
+    def aplicar(self, cambios):
+        # Mismas reglas que aplicar_cambios_df; el Detalle se vuelve a parsear solo si cambió
+        with self._lock:
+            for cambio in cambios:
+                clave = clave_id(cambio['id'])
+                campos = {c: v for c, v in cambio.get('campos', {}).items() if c in COLUMNAS_ESTRICTAS}
+                previo = self._registros.get(clave)
+                if cambio['tipo'] == 'eliminar': self._quitar(clave)
+                elif previo or cambio['tipo'] == 'insertar' or len(campos) == len(COLUMNAS_ESTRICTAS):
+                    registro = dict(previo or dict.fromkeys(COLUMNAS_ESTRICTAS, ""), **campos)
+                    if not previo: registro['ID_Pedido'] = str(cambio['id'])
+                    items = self._items.get(clave, [])
+                    if 'Detalle' in campos or not previo:
+                        items = [tuple(f[2:6]) for f in parsear_detalle(registro['ID_Pedido'], registro['Detalle'], self.catalogo)]
+                    self._poner(clave, registro, items)
+        return self
+
+    def tablas(self):
+        """DataFrames chicos listos para pintar: 'estado', 'grado' e 'imprimir'."""
+        with self._lock: sumas = list(self._sumas.items())
+        medidas = {"estado": ["Pedidos", "Total", "Abonado", "Saldo"],
+                   "grado": ["Pedidos", "Libros", "Ventas", "Saldo"],
+                   "imprimir": ["Cantidad"]}
+        filas = {nombre: {} for nombre in medidas}
+        for (tabla, fila, medida), valor in sumas:
+            filas[tabla].setdefault(fila, dict.fromkeys(medidas[tabla], 0.0))[medida] = valor
+        salida = {}
+        for nombre, claves in [("estado", ["Estado"]), ("grado", ["Grado"]), ("imprimir", ["Grado", "Area", "Libro"])]:
+            datos = [(*(f if isinstance(f, tuple) else (f,)), *v.values()) for f, v in filas[nombre].items()]
+            df = pd.DataFrame(datos, columns=claves + medidas[nombre])
+            for col in ["Pedidos", "Libros", "Cantidad"]:
+                if col in df.columns: df[col] = df[col].round().astype(int)
+            salida[nombre] = df.sort_values(claves).reset_index(drop=True)
+        return salida
+
+def agregados_pedidos():
+    # Se arma una vez por versión de Pedidos/Inventario y los guardados lo mantienen al día
+    cache = obtener_cache()
+    items_pedidos()
+    return cache.derivado(
+        "agregados_pedidos", ["Pedidos", "Inventario"],
+        lambda: AgregadosPedidos(_pedidos_o_vacio(), items_pedidos(), catalogo_inventario()),
+        actualizar=lambda agregados, cambios: agregados.aplicar(cambios))
+
+def resumen_inventario():
+    # Costo, venta y ganancia por grado: se calcula una vez por versión de Inventario
+    cache = obtener_cache()
+    inventario_compartido()
+    def construir():
+        inventario = inventario_compartido()
+        if inventario.empty: return pd.DataFrame()
+        df = inventario.assign(Ganancia=inventario['Precio Venta'] - inventario['Costo'])
+        return df.groupby("Grado", observed=True)[["Costo", "Precio Venta", "Ganancia"]].sum()
+    return cache.derivado("resumen_inventario", ["Inventario"], construir)
+
+# --- MINIATURAS DE COMPROBANTES ---
+class CacheMiniaturas:
+    """Miniaturas de los comprobantes en disco, descargadas una sola vez por el servidor.
+
+    Cada URL se baja con un número acotado de descargas a la vez, se reduce a LADO px y se
+    guarda como JPEG (nombre = sha1 de la URL). Cuando la carpeta pasa de max_bytes se borran
+    las menos usadas: cada lectura toca la fecha de modificación del archivo. Una URL que
+    falla no se vuelve a pedir hasta pasados REINTENTO_FALLIDA segundos.
+    """
+    LADO = 480
+    CALIDAD = 80
+    TIEMPO_ESPERA = 15
+    MAX_DESCARGA = 20 * 1024 * 1024
+    REINTENTO_FALLIDA = 600
+
+    def __init__(self, carpeta, max_bytes, simultaneas=4):
+        os.makedirs(carpeta, exist_ok=True)
+        self.carpeta = carpeta
+        self.max_bytes = max_bytes
+        self._semaforo = threading.BoundedSemaphore(simultaneas)
+        self._pool = ThreadPoolExecutor(max_workers=simultaneas, thread_name_prefix="miniaturas")
+        self._lock = threading.Lock()
+        self._en_curso = {}   # url -> Future: dos sesiones que piden la misma imagen esperan una sola descarga
+        self._fallidas = {}   # url -> instante del último fallo: cada render no espera otra vez TIEMPO_ESPERA
+        self._sesion = requests.Session()
+
+    def ruta(self, url):
+        return os.path.join(self.carpeta, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".jpg")
+
+    def obtener(self, url):
+        """Ruta local de la miniatura de `url`, o None si no se pudo descargar."""
+        ruta = self.ruta(url)
+        try:
+            os.utime(ruta)
+            return ruta
+        except OSError: pass
+        with self._lock:
+            fallo = self._fallidas.get(url)
+            if fallo is not None and time.monotonic() - fallo < self.REINTENTO_FALLIDA: return None
+            futuro = self._en_curso.get(url)
+            propio = futuro is None
+            if propio: futuro = self._en_curso[url] = Future()
+        if not propio: return futuro.result()
+        resultado = None
+        try: resultado = self._descargar(url, ruta)
+        except Exception as e: log.warning("No se pudo preparar la miniatura de %s: %s", url, e)
+        finally:
+            with self._lock:
+                self._en_curso.pop(url, None)
+                if resultado is None: self._fallidas[url] = time.monotonic()
+                else: self._fallidas.pop(url, None)
+        futuro.set_result(resultado)
+        return resultado
+
+    def precargar(self, urls):
+        # Baja en paralelo (con el mismo tope) las miniaturas que una vista va a pintar
+        pendientes = [u for u in dict.fromkeys(urls) if not os.path.exists(self.ruta(u))]
+        list(self._pool.map(self.obtener, pendientes))
+
+    def _descargar(self, url, ruta):
+        with self._semaforo, obtener_metricas().medir("descarga_comprobante"):
+            with self._sesion.get(url, timeout=self.TIEMPO_ESPERA, stream=True) as r:
+                r.raise_for_status()
+                datos = bytearray()
+                for trozo in r.iter_content(64 * 1024):
+                    datos += trozo
+                    if len(datos) > self.MAX_DESCARGA: raise ValueError("imagen demasiado grande")
+        imagen = ImageOps.exif_transpose(Image.open(io.BytesIO(datos)))
+        imagen.thumbnail((self.LADO, self.LADO))
+        temporal = f"{ruta}.{uuid.uuid4().hex}.tmp"
+        imagen.convert("RGB").save(temporal, "JPEG", quality=self.CALIDAD, optimize=True)
+        os.replace(temporal, ruta)
+        self._recortar()
+        return ruta
+
+    def _recortar(self):
+        # LRU por tamaño: se borran las más antiguas en uso hasta bajar al 90 % del tope
+        with self._lock:
+            archivos = []
+            for e in os.scandir(self.carpeta):
+                if not e.name.endswith(".jpg"): continue
+                try: info = e.stat()
+                except OSError: continue
+                archivos.append((info.st_mtime, info.st_size, e.path))
+            total = sum(a[1] for a in archivos)
+            if total <= self.max_bytes: return
+            for _, tam, ruta in sorted(archivos):
+                if total <= 0.9 * self.max_bytes: break
+                try:
+                    os.remove(ruta)
+                    total -= tam
+                except OSError: pass
+
+@st.cache_resource
+def obtener_miniaturas():
+    return CacheMiniaturas(MINIATURAS_RUTA, MINIATURAS_MAX_MB * 1024 * 1024)
+
+def urls_comprobantes(df):
+    valores = pd.concat([df['Comprobante'], df['Comprobante2']]).astype(str) if not df.empty else pd.Series(dtype=str)
+    return list(valores[valores.str.startswith("http")])
+
+def mostrar_comprobante(url, titulo):
+    # Se pinta la miniatura local; si no se pudo preparar, la imagen remota como antes
+    ruta = obtener_miniaturas().obtener(url)
+    st.image(ruta or url, caption=titulo, use_container_width=True)
+    st.markdown(f"[🔍 Ver original]({url})")
 
 # --- COMPONENTES VISUALES ---
 def generar_link_whatsapp(celular, mensaje):
@@ -204,141 +2011,193 @@ def generar_link_whatsapp(celular, mensaje):
     if not celular.startswith("57"): celular = "57" + celular
     return f"https://wa.me/{celular}?text={mensaje.replace(' ', '%20').replace(chr(10), '%0A')}"
 
-def generar_excel_matriz_bytes(df_pedidos, df_inventario):
+def construir_matriz(df_pedidos, df_inventario, items, solo_explicitas=False):
+    """Matriz pedido × área de todos los grados en una sola pasada sobre la tabla de items.
+
+    Devuelve {grado: (filas, areas)} en el orden del inventario. `filas` tiene las columnas
+    de df_pedidos (en su orden) que tienen algún libro del grado, una columna por área con
+    cuántos libros de esa área pidieron y 'Cant' con el total de libros reconocidos.
+    Con solo_explicitas=True solo cuentan las áreas escritas entre paréntesis.
+    """
+    matriz = {}
+    if df_pedidos.empty or df_inventario.empty: return matriz
+    areas_grado = {g: list(inv_g['Area'].unique()) for g, inv_g in df_inventario.groupby('Grado', sort=False, observed=True)}
+    items = items[items['Grado'].isin(list(areas_grado)) & items['ID_Pedido'].isin(df_pedidos['ID_Pedido'])]
+    resueltos = items[items['Area'].notna()]
+    if solo_explicitas: resueltos = resueltos[resueltos['Explicita'].astype(bool)]
+    
+    posiciones = pd.DataFrame({'ID_Pedido': df_pedidos['ID_Pedido'].values, '_fila': range(len(df_pedidos))})
+    filas = items[['Grado', 'ID_Pedido']].drop_duplicates().merge(posiciones, on='ID_Pedido')
+    conteo = resueltos.groupby(['Grado', 'ID_Pedido', 'Area']).size().unstack('Area', fill_value=0)
+    if not conteo.empty: filas = filas.join(conteo, on=['Grado', 'ID_Pedido'])
+    filas = filas.sort_values('_fila', kind='stable')
+    
+    for grado, bloque in filas.groupby('Grado', sort=False):
+        areas = areas_grado[grado]
+        presencia = bloque.reindex(columns=areas).fillna(0).astype(int).reset_index(drop=True)
+        datos = df_pedidos.iloc[bloque['_fila'].values].reset_index(drop=True)
+        for a in areas: datos[a] = presencia[a]
+        datos['Cant'] = presencia.sum(axis=1)
+        matriz[grado] = (datos, areas)
+    return {g: matriz[g] for g in areas_grado if g in matriz}
+
+def nombre_hoja_excel(texto):
+    # Excel no admite []:*?/\ en el nombre de la hoja y lo limita a 31 caracteres
+    return re.sub(r'[\[\]:*?/\\]', '-', str(texto))[:31]
+
+@medido("generar_excel")
+def generar_excel_matriz_bytes(df_pedidos, df_inventario, items=None, por_grado=False):
+    if items is None: items = construir_items(df_pedidos, df_inventario)
     output = io.BytesIO()
-    writer = pd.ExcelWriter(output, engine='xlsxwriter')
+    # constant_memory: cada fila se escribe al disco temporal en cuanto se pasa a la siguiente
+    writer = pd.ExcelWriter(output, engine='xlsxwriter', engine_kwargs={'options': {'constant_memory': True}})
     workbook = writer.book
-    worksheet = workbook.add_worksheet("Listado Matriz")
+    worksheet = None if por_grado else workbook.add_worksheet("Listado Matriz")
     fmt_header = workbook.add_format({'bold': True, 'bg_color': '#DDEBF7', 'border': 1})
     fmt_col = workbook.add_format({'bold': True, 'bg_color': '#FFF2CC', 'border': 1, 'align': 'center'})
     fmt_cell = workbook.add_format({'border': 1, 'align': 'center'})
     
     current_row = 0
-    grados = df_inventario['Grado'].unique()
-    for grado in grados:
-        inv_grado = df_inventario[df_inventario['Grado'] == grado]
-        if inv_grado.empty: continue
-        mapa = {normalizar_clave(k): v for k, v in zip(inv_grado['Libro'], inv_grado['Area'])}
-        areas = inv_grado['Area'].unique()
-        patron = f"[{grado}]"
-        pedidos_grado = df_pedidos[df_pedidos['Detalle'].str.contains(patron, regex=False, na=False)].copy()
-        if pedidos_grado.empty: continue
-
-        data_rows = []
-        for _, p in pedidos_grado.iterrows():
-            row = {
-                'Cliente': p['Cliente'], 
-                'Fecha_Creacion': p.get('Fecha_Creacion', ''),
-                'Ultima_Modificacion': p.get('Ultima_Modificacion', ''),
-                'Celular': p['Celular'], 
-                'Total': p['Total'], 
-                'Saldo': p['Saldo']
-            }
-            for a in areas: row[a] = 0
-            items = str(p['Detalle']).split(" | ")
-            count = 0
-            for item in items:
-                if patron in item:
-                    area_enc = None
-                    match = re.search(r'\((.*?)\)', item)
-                    if match:
-                        posible = match.group(1).strip()
-                        for a in areas:
-                            if str(a).strip().lower() == posible.lower():
-                                area_enc = a
-                                break
-                    if not area_enc:
-                        raw = item.replace(patron, "").strip()
-                        area_enc = mapa.get(normalizar_clave(raw))
-                    if area_enc:
-                        row[area_enc] = 1
-                        count += 1
-            row['Cant'] = count
-            data_rows.append(row)
-        if not data_rows: continue
-        
+    for grado, (datos, areas) in construir_matriz(df_pedidos, df_inventario, items).items():
+        if por_grado:
+            worksheet = workbook.add_worksheet(nombre_hoja_excel(f"Grado {grado}"))
+            current_row = 0
         worksheet.write(current_row, 0, f"GRADO: {grado}", fmt_header)
         current_row += 1
         
         headers = ['Cliente', 'Fecha Creación', 'Últ. Modif', 'Celular', 'Total', 'Saldo'] + list(areas) + ['Cant']
-        for i, h in enumerate(headers): worksheet.write(current_row, i, h, fmt_col)
+        worksheet.write_row(current_row, 0, headers, fmt_col)
         current_row += 1
-        for d in data_rows:
-            worksheet.write(current_row, 0, d['Cliente'], fmt_cell)
-            worksheet.write(current_row, 1, d['Fecha_Creacion'], fmt_cell)
-            worksheet.write(current_row, 2, d['Ultima_Modificacion'], fmt_cell)
-            worksheet.write(current_row, 3, d['Celular'], fmt_cell)
-            worksheet.write(current_row, 4, d['Total'], fmt_cell)
-            worksheet.write(current_row, 5, d['Saldo'], fmt_cell)
-            for i, a in enumerate(areas):
-                val = d[a]
-                worksheet.write(current_row, 6+i, val if val > 0 else "", fmt_cell)
-            worksheet.write(current_row, 6+len(areas), d['Cant'], fmt_cell)
+        
+        celdas = datos[['Cliente', 'Fecha_Creacion', 'Ultima_Modificacion', 'Celular', 'Total', 'Saldo']].copy()
+        for c in COLUMNAS_FECHA: celdas[c] = texto_fechas(celdas[c])
+        for a in areas: celdas[a] = datos[a].clip(upper=1).astype(object).where(datos[a] > 0, "")
+        celdas['Cant'] = datos['Cant']
+        for fila in celdas.itertuples(index=False, name=None):
+            worksheet.write_row(current_row, 0, fila, fmt_cell)
             current_row += 1
         current_row += 2
+    if worksheet is None: workbook.add_worksheet("Listado Matriz")
     writer.close()
     return output
 
-def componente_seleccion_libros(inventario, key_suffix, seleccion_previa=None, reset_counter=0):
-    grados = inventario['Grado'].unique()
-    seleccion = []
-    total = 0
-    for grado in grados:
-        df_g = inventario[inventario['Grado'] == grado]
-        with st.expander(f"{grado}"):
-            for _, r in df_g.iterrows():
-                key = f"{grado}_{r['Area']}_{r['Libro']}_{key_suffix}_{reset_counter}"
-                nombre = str(r['Libro']).strip()
-                area = str(r['Area']).strip()
-                precio = limpiar_moneda(r['Precio Venta'])
-                label = f"{area} - {nombre} (${int(precio):,})"
-                item_new = f"[{grado}] ({area}) {nombre}"
-                item_old = f"[{grado}] {nombre}"
-                checked = False
-                if seleccion_previa:
-                    if item_new in seleccion_previa or item_old in seleccion_previa: checked = True
-                if st.checkbox(label, key=key, value=checked):
-                    seleccion.append(item_new)
-                    total += precio
-    return seleccion, total
+def _hojas_reporte(temporada):
+    # "Activa" sale solo de la hoja de pedidos; "Todas" o un año también del archivo
+    return ["Pedidos", "Inventario"] if temporada == "Activa" else ["Pedidos", "Archivo", "Inventario"]
+
+def _reporte_vigente(por_grado, temporada="Activa"):
+    cache = obtener_cache()
+    pedidos_compartidos()
+    cache.obtener("Inventario", _leer_inventario, copia=False)
+    if temporada != "Activa": cache.obtener("Archivo", _leer_archivo, copia=False)
+    return cache.derivado_vigente(f"reporte_excel_{por_grado}_{temporada}", _hojas_reporte(temporada))
+
+def reporte_excel(por_grado=False, temporada="Activa"):
+    """Bytes del reporte matriz, generado solo una vez por versión de los datos que usa."""
+    cache = obtener_cache()
+    pedidos = pedidos_compartidos()
+    inventario = cache.obtener("Inventario", _leer_inventario, copia=False)
+    if pedidos is None or inventario is None: return None
+    if temporada != "Activa": cargar_archivo()
+    if temporada == "Activa":
+        construir = lambda: generar_excel_matriz_bytes(_pedidos_o_vacio(), inventario_compartido(), items_pedidos(), por_grado=por_grado).getvalue()
+    else:
+        def construir():
+            todos = pd.concat([cargar_archivo()[COLUMNAS_ESTRICTAS], _pedidos_o_vacio()], ignore_index=True)
+            if temporada != "Todas": todos = todos[temporada_pedidos(todos) == temporada].reset_index(drop=True)
+            items = construir_items(todos, None, catalogo_inventario())
+            return generar_excel_matriz_bytes(todos, inventario_compartido(), items, por_grado=por_grado).getvalue()
+    return cache.derivado(f"reporte_excel_{por_grado}_{temporada}", _hojas_reporte(temporada), construir)
+
+def catalogo_selector():
+    # Grado -> libros listos para pintar; se arma una vez por versión de Inventario
+    def construir():
+        inventario = inventario_compartido()
+        catalogo = {}
+        for grado, area, libro, precio in zip(inventario['Grado'], inventario['Area'], inventario['Libro'], inventario['Precio Venta']):
+            nombre, area, precio = str(libro).strip(), str(area).strip(), float(precio)
+            catalogo.setdefault(grado, []).append({
+                "key": f"{grado}_{area}_{nombre}", "label": f"{area} - {nombre} (${int(precio):,})",
+                "item": f"[{grado}] ({area}) {nombre}", "item_old": f"[{grado}] {nombre}", "precio": precio})
+        return catalogo
+    return obtener_cache().derivado("selector_libros", ["Inventario"], construir)
+
+def _marcar_libro(estado, item, key):
+    if st.session_state[key]: st.session_state[estado].add(item)
+    else: st.session_state[estado].discard(item)
+
+def _totales_seleccion(catalogo, seleccion):
+    libros = [l for grado in catalogo for l in catalogo[grado] if l['item'] in seleccion]
+    return [l['item'] for l in libros], sum(l['precio'] for l in libros)
+
+@fragmento("selector_libros")
+@medido("selector_libros")
+def _selector_libros(catalogo, estado, sufijo, resumen):
+    # Marcar un libro solo vuelve a correr este bloque, no toda la página
+    seleccion = st.session_state[estado]
+    grados = list(catalogo)
+    def etiqueta(grado):
+        marcados = sum(l['item'] in seleccion for l in catalogo[grado])
+        return f"{grado} ({marcados})" if marcados else f"{grado}"
+    grado = st.radio("Grado:", grados, format_func=etiqueta, horizontal=True, key=f"grado_{sufijo}")
+    # Solo se crean las casillas del grado elegido
+    for l in catalogo.get(grado, []):
+        key = f"{l['key']}_{sufijo}"
+        st.checkbox(l['label'], key=key, value=l['item'] in seleccion, on_change=_marcar_libro, args=(estado, l['item'], key))
+    if resumen: resumen(*_totales_seleccion(catalogo, seleccion))
+
+def sufijo_seleccion(key_suffix, seleccion_previa=None, reset_counter=0):
+    # La selección previa entra en la clave: otro pedido (o el mismo ya modificado) arranca de su Detalle
+    sufijo = f"{key_suffix}_{reset_counter}"
+    if seleccion_previa: sufijo += "_" + hashlib.md5(seleccion_previa.encode()).hexdigest()[:8]
+    return sufijo
+
+def olvidar_seleccion(key_suffix, seleccion_previa=None, reset_counter=0):
+    # Tras guardar: la selección no debe sobrevivir en la sesión (p.ej. al volver con "⬅️ Inicio")
+    st.session_state.pop(f"seleccion_{sufijo_seleccion(key_suffix, seleccion_previa, reset_counter)}", None)
+
+@medido("componente_seleccion_libros")
+def componente_seleccion_libros(inventario, key_suffix, seleccion_previa=None, reset_counter=0, resumen=None):
+    """Selector de libros por grado; devuelve (items, total) de lo marcado.
+
+    La selección vive en session_state, así que cambiar de grado no la pierde.
+    `key_suffix` distingue cada formulario (incluido el pedido que se edita).
+    `resumen(items, total)` se pinta dentro del mismo fragmento (total, saldo...).
+    """
+    catalogo = catalogo_selector()
+    sufijo = sufijo_seleccion(key_suffix, seleccion_previa, reset_counter)
+    estado = f"seleccion_{sufijo}"
+    if estado not in st.session_state:
+        st.session_state[estado] = {l['item'] for grado in catalogo for l in catalogo[grado]
+                                    if seleccion_previa and (l['item'] in seleccion_previa or l['item_old'] in seleccion_previa)}
+    _selector_libros(catalogo, estado, sufijo, resumen)
+    return _totales_seleccion(catalogo, st.session_state[estado])
 
 def renderizar_matriz_lectura(fila, inventario):
-    st.markdown(f"**Pedido:** {fila['ID_Pedido']} | **Fecha:** {fila['Fecha_Creacion']}")
+    st.markdown(f"**Pedido:** {fila['ID_Pedido']} | **Fecha:** {valor_celda(fila['Fecha_Creacion'])}")
     c1, c2, c3 = st.columns(3)
-    tot = limpiar_moneda(fila.get('Total', 0))
-    abo = limpiar_moneda(fila.get('Abonado', 0))
-    sal = limpiar_moneda(fila.get('Saldo', 0))
+    tot = fila.get('Total', 0.0)
+    abo = fila.get('Abonado', 0.0)
+    sal = fila.get('Saldo', 0.0)
 
     c1.metric("Total", f"${tot:,.0f}")
     c2.metric("Abonado", f"${abo:,.0f}")
     c3.metric("Saldo", f"${sal:,.0f}", delta_color="inverse")
     
-    detalles = str(fila['Detalle'])
-    items = detalles.split(" | ")
-    libros_grado = {}
-    for item in items:
-        match = re.search(r'\[(.*?)\]', item)
-        if match:
-            g = match.group(1)
-            if g not in libros_grado: libros_grado[g] = []
-            libros_grado[g].append(item)
+    pid = str(fila['ID_Pedido'])
+    # items_pedidos() solo cubre Pedidos activos: una fila del archivo trae Temporada y se parsea aquí
+    if 'Temporada' in fila.index: propios = pd.DataFrame(parsear_detalle(pid, fila.get('Detalle', ''), catalogo_inventario()), columns=COLUMNAS_ITEMS)
+    else:
+        items = items_pedidos()
+        propios = items[items['ID_Pedido'] == pid].sort_values('Pos')
             
-    for g, lista in libros_grado.items():
+    for g, items_g in propios.groupby('Grado', sort=False):
         st.caption(f"🎓 Grado: {g}")
         inv_g = inventario[inventario['Grado'] == g]
         if not inv_g.empty:
             areas = inv_g['Area'].unique()
-            data = {a: ["❌"] for a in areas}
-            for it in lista:
-                area_enc = None
-                match_a = re.search(r'\((.*?)\)', it)
-                if match_a:
-                    pos = match_a.group(1).strip()
-                    for a in areas:
-                        if str(a).strip().lower() == pos.lower():
-                            area_enc = a
-                            break
-                if area_enc: data[area_enc] = ["✅"]
+            marcadas = set(items_g.loc[items_g['Explicita'], 'Area'])
+            data = {a: ["✅" if a in marcadas else "❌"] for a in areas}
             st.table(pd.DataFrame(data))
 
     st.markdown("**📂 Soportes Adjuntos:**")
@@ -347,12 +2206,12 @@ def renderizar_matriz_lectura(fila, inventario):
     s2 = str(fila.get('Comprobante2', 'No'))
     
     with cs1:
-        if s1.startswith("http"): st.image(s1, caption="Soporte 1", use_container_width=True)
+        if s1.startswith("http"): mostrar_comprobante(s1, "Soporte 1")
         elif s1 not in ['No', 'Manual', 'Manual/Presencial', 'nan']: st.warning("Imagen no disponible")
         else: st.info("Sin soporte inicial")
         
     with cs2:
-        if s2.startswith("http"): st.image(s2, caption="Soporte 2", use_container_width=True)
+        if s2.startswith("http"): mostrar_comprobante(s2, "Soporte 2")
         elif s2 not in ['No', 'nan']: st.warning("Imagen no disponible")
         else: st.info("-")
     st.divider()
@@ -375,6 +2234,12 @@ def formulario_pedido(pedido_id):
             datos = row.iloc[0].to_dict()
             es_modif = True
             st.info(f"📝 Editando Pedido: {datos['ID_Pedido']}")
+        else:
+            arch = buscar_en_archivo(id_pedido=pedido_id)
+            if not arch.empty:
+                st.warning(f"El pedido {pedido_id} es de la temporada {arch.iloc[0]['Temporada']}, ya archivada: solo se puede consultar.")
+                renderizar_matriz_lectura(arch.iloc[0], inventario)
+                return
 
     c1, c2 = st.columns(2)
     nom = c1.text_input("Nombre Completo", value=datos.get('Cliente', ''))
@@ -382,12 +2247,20 @@ def formulario_pedido(pedido_id):
 
     st.divider()
     st.subheader("Necesito ayuda en:")
-    items, total = componente_seleccion_libros(inventario, "form", datos.get('Detalle', ''))
-    
-    st.divider()
-    cm, cb = st.columns([2,1])
-    cm.metric("Total a Pagar", f"${total:,.0f}")
-    if cb.button("🔄 Actualizar Precio"): pass
+    prev_abo = float(datos.get('Abonado', 0.0))
+    def resumen(items, total):
+        st.divider()
+        st.metric("Total a Pagar", f"${total:,.0f}")
+        # --- BLOQUE DEUDA UNIFICADO (SOLO LECTURA) ---
+        if es_modif:
+            st.markdown(f"""
+            <div style="margin-top: 10px; margin-bottom: 15px; line-height: 1.2;">
+                <div><strong>Abono Previo:</strong> ${prev_abo:,.0f}</div>
+                <div style="color: #d9534f;"><strong>Saldo Deuda:</strong> ${total - prev_abo:,.0f}</div>
+            </div>
+            """, unsafe_allow_html=True)
+    clave_form = f"form_{datos['ID_Pedido']}" if es_modif else "form_nuevo"
+    items, total = componente_seleccion_libros(inventario, clave_form, datos.get('Detalle', ''), resumen=resumen)
     
     st.subheader("Pagos y Soportes")
     
@@ -413,17 +2286,6 @@ def formulario_pedido(pedido_id):
 * Para confirmar su pedido, se requiere de un anticipo del 50% y el saldo Contraentrega.
 * Tiempo de Entrega entre 6 días hábiles, contados a partir del pago del anticipo.""")
     
-    # --- BLOQUE DEUDA UNIFICADO (SOLO LECTURA) ---
-    prev_abo = limpiar_moneda(datos.get('Abonado', 0))
-    saldo_pend = total - prev_abo
-    if es_modif:
-        st.markdown(f"""
-        <div style="margin-top: 10px; margin-bottom: 15px; line-height: 1.2;">
-            <div><strong>Abono Previo:</strong> ${prev_abo:,.0f}</div>
-            <div style="color: #d9534f;"><strong>Saldo Deuda:</strong> ${saldo_pend:,.0f}</div>
-        </div>
-        """, unsafe_allow_html=True)
-    
     st.write("---")
     if st.button("✅ CONFIRMAR Y GUARDAR"):
         with st.spinner("Guardando Pedido..."):
@@ -432,12 +2294,11 @@ def formulario_pedido(pedido_id):
             if not nom or not cel: st.error("Faltan datos personales")
             elif total == 0: st.error("Seleccione libros")
             else:
-                df_ped = cargar_pedidos()
                 fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 saldo = total - acumulado
                 
                 if es_modif: curr_id = str(pedido_id)
-                else: curr_id = obtener_nuevo_id(df_ped)
+                else: curr_id = id_formulario(clave_form)
                 
                 n_f1 = datos.get('Comprobante', 'No')
                 n_f2 = datos.get('Comprobante2', 'No')
@@ -453,17 +2314,16 @@ def formulario_pedido(pedido_id):
                     "Comprobante": n_f1, "Comprobante2": n_f2, "Historial_Cambios": hist
                 }
                 
-                if es_modif:
-                    idx = df_ped[df_ped['ID_Pedido'] == curr_id].index
-                    if not idx.empty:
-                        for k, v in nuevo_registro.items(): df_ped.at[idx[0], k] = v
-                else:
-                    df_ped = pd.concat([df_ped, pd.DataFrame([nuevo_registro])], ignore_index=True)
+                if not curr_id: ok = False
+                elif es_modif: ok = actualizar_pedido_db(curr_id, nuevo_registro)
+                else: ok = insertar_pedido_db(nuevo_registro)
                 
-                guardar_pedido_db(df_ped)
-                st.session_state.exito_cliente = True
-                st.session_state.ultimo_pedido_cliente = curr_id
-                st.rerun()
+                if ok:
+                    olvidar_seleccion(clave_form, datos.get('Detalle', ''))
+                    soltar_id_formulario(clave_form)
+                    st.session_state.exito_cliente = True
+                    st.session_state.ultimo_pedido_cliente = curr_id
+                    st.rerun()
 
 def vista_cliente(pid_param=None):
     if pid_param:
@@ -484,17 +2344,14 @@ def vista_cliente(pid_param=None):
         b = st.text_input("Tu celular registrado:")
         if st.button("Buscar"):
             if b:
-                df = cargar_pedidos()
+                res = pedidos_por_celular(b, archivo=True)
                 inv = cargar_inventario()
-                clean = limpiar_numero(b)
-                df['cc'] = df['Celular'].apply(limpiar_numero)
-                res = df[df['cc'] == clean]
                 if res.empty: st.error("No encontrado")
                 else:
-                    res['Saldo_Num'] = res['Saldo'].apply(limpiar_moneda)
-                    pends = res[res['Saldo_Num'] > 0]
+                    pends = res[res['Saldo'] > 0]
                     if not pends.empty:
                         st.info(f"Tienes {len(pends)} pedidos pendientes:")
+                        obtener_miniaturas().precargar(urls_comprobantes(pends))
                         for _, r in pends.iterrows(): renderizar_matriz_lectura(r, inv)
                     else:
                         st.success("Estás al día. Último pedido:")
@@ -506,15 +2363,12 @@ def vista_cliente(pid_param=None):
         if st.button("Buscar Pendientes"): st.session_state.edit_found = False
         
         if b:
-            df = cargar_pedidos()
-            clean = limpiar_numero(b)
-            df['cc'] = df['Celular'].apply(limpiar_numero)
-            df['Saldo_Num'] = df['Saldo'].apply(limpiar_moneda)
-            pends = df[(df['cc'] == clean) & (df['Saldo_Num'] > 0)]
+            res = pedidos_por_celular(b)
+            pends = res[res['Saldo'] > 0]
             
             if pends.empty: st.info("No tienes deudas pendientes.")
             else:
-                opts = {f"{r['ID_Pedido']} - {r['Fecha_Creacion']} ($ Deuda: {r['Saldo']})": r['ID_Pedido'] for _, r in pends.iterrows()}
+                opts = {f"{r['ID_Pedido']} - {valor_celda(r['Fecha_Creacion'])} ($ Deuda: {r['Saldo']:,.0f})": r['ID_Pedido'] for _, r in pends.iterrows()}
                 sel = st.selectbox("Selecciona pedido:", list(opts.keys()))
                 if sel:
                     st.divider()
@@ -535,9 +2389,250 @@ def vista_exito(pid):
         st.session_state.exito_cliente = False
         st.rerun()
 
+# --- SECCIONES DEL PANEL VENTAS ---
+# Cada sección es un fragmento: sus widgets solo vuelven a correr esa sección.
+# Los guardados llaman st.rerun() para refrescar la foto de datos de todo el panel.
+@fragmento("admin/manual")
+def seccion_pedido_manual(inv):
+    mn, mc = st.columns(2)
+    nom = mn.text_input("Cliente", key="mn")
+    cel = mc.text_input("Cel", key="mc")
+    its, tot = componente_seleccion_libros(inv, "man", reset_counter=st.session_state.reset_manual,
+                                           resumen=lambda items, total: st.metric("Total", f"${total:,.0f}"))
+    abo = st.number_input("Abono:", step=1000.0)
+    est = st.selectbox("Estado:", ["Nuevo", "Pagado Total", "Entregado"])
+    
+    if st.button("Guardar Manual"):
+        if not nom: st.error("Nombre?")
+        else:
+            fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            nid = id_formulario(f"man_{st.session_state.reset_manual}")
+            nuevo = {
+                "ID_Pedido": nid, "Fecha_Creacion": fecha, "Ultima_Modificacion": fecha,
+                "Cliente": nom, "Celular": cel, "Detalle": " | ".join(its),
+                "Total": tot, "Abonado": abo, "Saldo": tot - abo, "Estado": est,
+                "Comprobante": "Manual", "Comprobante2": "No", "Historial_Cambios": "Admin Manual"
+            }
+            if nid and insertar_pedido_db(nuevo):
+                st.success(f"Guardado ID: {nid}")
+                olvidar_seleccion("man", reset_counter=st.session_state.reset_manual)
+                soltar_id_formulario(f"man_{st.session_state.reset_manual}")
+                st.session_state.reset_manual += 1
+                st.rerun()
+
+@fragmento("admin/reporte")
+def seccion_reporte():
+    cr1, cr2, cr3 = st.columns([1, 1, 1])
+    por_grado = cr2.toggle("Una hoja por grado", key="reporte_por_grado")
+    temporada = cr3.selectbox("Temporada:", ["Activa"] + temporadas_archivadas() + ["Todas"], key="reporte_temporada")
+    try:
+        excel = _reporte_vigente(por_grado, temporada)
+        if excel is None and cr1.button("📊 Preparar Reporte"):
+            with st.spinner("Generando reporte..."): excel = reporte_excel(por_grado, temporada)
+    except ErrorAlmacen as e:
+        st.error(f"⚠️ No se pudo preparar el reporte: {e}")
+        return
+    if excel is not None: cr1.download_button("📥 Descargar Reporte", excel, "Reporte_Matriz.xlsx")
+
+@fragmento("admin/listado")
+def seccion_listado(df, inv):
+    filtro = st.text_input("Buscar Pedido:", placeholder="Nombre, celular o ID...")
+    df_view = df
+    if filtro:
+        # Las filas siguen el orden de relevancia del índice: con filtro, "Llegada" es ese orden.
+        # Se ordena por el puesto de cada ID, así un ID repetido en la hoja trae todas sus filas
+        puesto = {pid: i for i, pid in enumerate(indice_busqueda().buscar(filtro))}
+        rango = df['ID_Pedido'].map(puesto)
+        df_view = df.loc[rango.dropna().sort_values(kind="stable").index]
+    
+    vista_modo = st.radio("Modo de Visualización:", ["Vista Lista (Edición Rápida)", "Vista Matriz (Detallada)"], horizontal=True)
+    
+    if vista_modo == "Vista Lista (Edición Rápida)": vista_lista(df, df_view)
+    else:
+        st.info("ℹ️ Visualización de items comprados por grado.")
+        if not inv.empty: vista_matriz(df_view, inv)
+
+def pagina_pedidos(df_view, orden, ascendente, tam_pagina, pagina):
+    # Ordena y recorta antes de pintar: al navegador solo llega la página actual.
+    # "Llegada" respeta el orden en que viene df_view (la hoja, o la relevancia si hay búsqueda)
+    if orden != "Llegada": df_view = df_view.sort_values(orden, ascending=ascendente, kind="stable")
+    elif not ascendente: df_view = df_view.iloc[::-1]
+    inicio = (pagina - 1) * tam_pagina
+    return df_view.iloc[inicio:inicio + tam_pagina]
+
+def vista_lista(df, df_view):
+    cols_base = ["ID_Pedido", "Fecha_Creacion", "Ultima_Modificacion", "Cliente", "Estado", "Total", "Abonado", "Saldo", "Celular"]
+    cols_extra = [c for c in df_view.columns if c not in cols_base]
+    df_view = df_view[cols_base + cols_extra]
+    
+    co1, co2, co3, co4 = st.columns([2, 1, 1, 1])
+    orden = co1.selectbox("Ordenar por:", ["Llegada"] + cols_base, key="lista_orden")
+    ascendente = co2.toggle("Ascendente", value=True, key="lista_asc")
+    tam_pagina = co3.selectbox("Por página:", [25, 50, 100, 200], index=1, key="lista_tam")
+    paginas = max(1, -(-len(df_view) // tam_pagina))
+    pagina = co4.number_input("Página:", min_value=1, max_value=paginas, value=1, step=1, key="lista_pagina")
+    pagina = min(pagina, paginas)
+    df_pag = pagina_pedidos(df_view, orden, ascendente, tam_pagina, pagina)
+    
+    # Marca de "modificado después de creado" en una sola comparación de columnas
+    modificado = df_pag['Ultima_Modificacion'] > df_pag['Fecha_Creacion']
+    estilos = pd.DataFrame('', index=df_pag.index, columns=df_pag.columns)
+    estilos.loc[modificado, 'Ultima_Modificacion'] = 'color: #d9534f; font-weight: bold;'
+
+    st.caption("💡 Fechas en rojo indican modificaciones posteriores. **Nota:** Puedes editar el 'Estado', 'Abonado' y 'Saldo' en la tabla de abajo.")
+    st.caption(f"Mostrando {len(df_pag)} de {len(df_view)} pedidos (página {pagina} de {paginas}).")
+    st.dataframe(df_pag.style.apply(lambda _: estilos, axis=None), use_container_width=True)
+    
+    st.markdown("**Editar Registros Financieros y de Estado:**")
+    # La clave depende de los pedidos de la página: las ediciones no se pasan a otra página
+    # El editor recibe el estado como texto: la categoría limitaría las opciones a las ya usadas
+    edited = st.data_editor(
+        df_pag[["ID_Pedido", "Cliente", "Estado", "Abonado", "Saldo"]].astype({"Estado": str}),
+        column_config={
+            "Estado": st.column_config.SelectboxColumn(options=["Nuevo", "Pagado", "En Impresión", "Entregado", "Anulado"]),
+            "ID_Pedido": st.column_config.TextColumn(disabled=True),
+            "Cliente": st.column_config.TextColumn(disabled=True),
+        },
+        hide_index=True, use_container_width=True, key=f"editor_rapido_{hash(tuple(df_pag['ID_Pedido']))}"
+    )
+    
+    if st.button("💾 Guardar Cambios"):
+        fecha_actual = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cambios = cambios_edicion_rapida(df, edited, fecha_actual)
+        if cambios:
+            if guardar_cambios_pedidos(cambios):
+                st.success("¡Registros guardados con éxito!")
+                st.rerun()
+        else: st.info("No detecté cambios.")
+
+@fragmento("admin/matriz")
+def vista_matriz(df_view, inv):
+    grados_disp = list(inv['Grado'].unique())
+    grado_sel = st.selectbox("Selecciona Grado:", grados_disp)
+    if grado_sel:
+        matriz = construir_matriz(df_view, inv[inv['Grado'] == grado_sel], items_pedidos(), solo_explicitas=True)
+        if grado_sel in matriz:
+            df_grado, areas = matriz[grado_sel]
+            for a in areas: df_grado[a] = df_grado[a] > 0
+            
+            cols_ver = ["ID_Pedido", "Fecha_Creacion", "Ultima_Modificacion", "Cliente", "Estado"] + list(areas)
+            st.dataframe(df_grado[cols_ver], hide_index=True, use_container_width=True)
+        else: st.warning(f"No hay pedidos para {grado_sel}")
+
+@fragmento("admin/gestion")
+def seccion_gestion(df):
+    indice = indice_busqueda()
+    bf = st.text_input("Filtrar Gestión:", placeholder="ID, nombre o celular...")
+    # Con filtro, las opciones salen del índice ordenadas por relevancia
+    opts = indice.etiquetas(indice.buscar(bf)) if bf else indice.etiquetas()
+    
+    lista_clientes = ["-Selección del cliente-"] + opts
+    sel_g = st.selectbox("Seleccionar:", lista_clientes)
+    
+    if sel_g and sel_g != "-Selección del cliente-":
+        id_sel = sel_g.split(" - ")[0]
+        filas_sel = df[df['ID_Pedido'] == id_sel]
+        if filas_sel.empty:
+            st.warning("El pedido cambió desde la última carga. Recarga la página.")
+            return
+        row_sel = filas_sel.iloc[0]
+        
+        c1, c2, c3 = st.columns(3)
+        with c1:
+            st.caption("Soporte 1")
+            s1 = str(row_sel.get('Comprobante', 'No'))
+            if s1.startswith("http"): mostrar_comprobante(s1, "Soporte 1")
+            else: st.info("Sin imagen Online")
+        with c2:
+            st.caption("Soporte 2")
+            s2 = str(row_sel.get('Comprobante2', 'No'))
+            if s2.startswith("http"): mostrar_comprobante(s2, "Soporte 2")
+            else: st.info("-")
+        with c3:
+            if st.button("🗑️ ELIMINAR PEDIDO", type="primary"):
+                if eliminar_pedido_db(id_sel):
+                    st.success("Eliminado")
+                    st.rerun()
+
+def vista_tablero():
+    st.title("📈 Tablero de Ventas")
+    tablas = agregados_pedidos().tablas()
+    estados, grados, imprimir = tablas['estado'], tablas['grado'], tablas['imprimir']
+    dinero = {c: st.column_config.NumberColumn(format="dollar") for c in ["Total", "Abonado", "Saldo", "Ventas"]}
+
+    vigentes = estados[~estados['Estado'].isin(ESTADOS_SIN_VENTA)]
+    k1, k2, k3, k4 = st.columns(4)
+    k1.metric("Pedidos", int(vigentes['Pedidos'].sum()))
+    k2.metric("Vendido", f"${vigentes['Total'].sum():,.0f}")
+    k3.metric("Recaudado", f"${vigentes['Abonado'].sum():,.0f}")
+    k4.metric("Por cobrar", f"${vigentes['Saldo'].sum():,.0f}")
+
+    st.subheader("Por estado")
+    st.dataframe(estados, hide_index=True, use_container_width=True, column_config=dinero)
+
+    st.subheader("Por grado")
+    st.caption("El saldo de cada pedido se reparte entre sus grados según el precio de los libros. No incluye pedidos anulados.")
+    st.dataframe(grados, hide_index=True, use_container_width=True, column_config=dinero)
+
+    st.subheader(f"🖨️ Libros por imprimir ({ESTADO_IMPRESION})")
+    if imprimir.empty: st.info(f"No hay pedidos en estado '{ESTADO_IMPRESION}'.")
+    else:
+        st.dataframe(imprimir, hide_index=True, use_container_width=True)
+        st.download_button("📥 Descargar CSV", imprimir.to_csv(index=False).encode("utf-8"), "libros_por_imprimir.csv")
+
+def vista_rendimiento():
+    st.title("⏱️ Rendimiento")
+    metricas = obtener_metricas()
+    por_minuto = metricas.llamadas_ultimo_minuto()
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Llamadas API (último minuto)", f"{por_minuto} / {CUOTA_POR_MINUTO}")
+    resumen = metricas.resumen()
+    api = resumen[resumen['Operación'].str.startswith("api.")]
+    c2.metric("Llamadas API (total)", int(api['Llamadas'].sum()))
+    c3.metric("Errores API", int(api['Errores'].sum()))
+    st.progress(min(por_minuto / max(CUOTA_POR_MINUTO, 1), 1.0))
+    if por_minuto >= LimitadorApi.UMBRAL * CUOTA_POR_MINUTO:
+        st.warning("Cerca del límite de la cuota de Google Sheets: las lecturas no críticas se están omitiendo.")
+    reintentos = resumen.loc[resumen['Operación'] == "reintento_api", 'Llamadas'].sum()
+    st.caption(f"Reintentos por 429/5xx: {int(reintentos)} · Lecturas no críticas descartadas por cuota: {obtener_limitador().descartadas}")
+
+    st.subheader("Operaciones")
+    st.caption("p50/p95 sobre las últimas 500 llamadas de cada operación.")
+    st.dataframe(resumen, hide_index=True, use_container_width=True,
+                 column_config={c: st.column_config.NumberColumn(format="%.1f") for c in ["p50 ms", "p95 ms", "Máx ms", "Total s"]})
+
+    st.subheader("Corridas recientes")
+    corridas = metricas.corridas_recientes()
+    if corridas.empty: st.info("Aún no hay corridas registradas.")
+    else:
+        ms = corridas['Duración ms']
+        k1, k2, k3 = st.columns(3)
+        k1.metric("Corridas", len(corridas))
+        k2.metric("p50", f"{ms.quantile(0.5):,.0f} ms")
+        k3.metric("p95", f"{ms.quantile(0.95):,.0f} ms")
+        st.caption("Las 20 más lentas:")
+        st.dataframe(corridas.nlargest(20, 'Duración ms'), hide_index=True, use_container_width=True,
+                     column_config={c: st.column_config.NumberColumn(format="%.0f") for c in ["Duración ms", "API ms"]})
+
+    e1, e2 = st.columns(2)
+    datos = {"resumen": resumen.to_dict('records'), "corridas": corridas.to_dict('records')}
+    e1.download_button("📥 Exportar JSON", json.dumps(datos, ensure_ascii=False, default=str), "metricas.json")
+    if e2.button("🔄 Reiniciar métricas"):
+        metricas.reiniciar()
+        st.rerun()
+    if METRICAS_LOG: st.caption(f"Cada corrida también se anota en {METRICAS_LOG}.")
+
 def vista_admin():
     url_app = "https://app-libros-escolares-kayrovn4lncquvsdmusqd8.streamlit.app/"
-    menu = st.sidebar.radio("Ir a:", ["📊 Ventas", "📦 Inventario", "⚙️ Configuración"])
+    menu = st.sidebar.radio("Ir a:", ["📊 Ventas", "📈 Tablero", "📦 Inventario", "⚙️ Configuración", "⏱️ Rendimiento"])
+    
+    if menu == "📈 Tablero":
+        vista_tablero()
+        return
+
+    if menu == "⏱️ Rendimiento":
+        vista_rendimiento()
+        return
     
     if menu == "⚙️ Configuración":
         st.title("⚙️ Configuración del Sistema")
@@ -549,28 +2644,51 @@ def vista_admin():
                 st.success("¡Número actualizado exitosamente!")
                 st.rerun()
             else: st.error("Error guardando en Google Sheets.")
+        
+        st.divider()
+        st.subheader("🧹 Mantenimiento")
+        st.caption("Reescribe toda la hoja 'Pedidos' con el orden estricto de columnas. Úsalo solo para reparar la hoja.")
+        if st.button("Compactar / Reparar Pedidos"):
+            # Lectura fresca dentro del hilo escritor: nunca desde una copia de caché
+            resultado = compactar_pedidos_db()
+            if resultado:
+                compactados, repetidos = resultado
+                if compactados == 0: st.warning("No se leyeron pedidos; no se reescribe la hoja.")
+                else: st.success(f"Hoja compactada: {compactados} pedidos.")
+                if repetidos: st.warning(f"IDs repetidos con datos distintos (corrígelos en la hoja): {', '.join(repetidos)}")
+        
+        st.caption("Mueve los pedidos de una temporada (año) cerrada a su hoja de archivo; la hoja 'Pedidos' queda solo con los activos.")
+        df_act = cargar_pedidos()
+        cerradas = sorted(t for t in temporada_pedidos(df_act).unique() if t.isdigit() and t < str(datetime.now().year))
+        if cerradas:
+            ca1, ca2 = st.columns([1, 2])
+            temp_sel = ca1.selectbox("Temporada a archivar:", cerradas)
+            if ca2.button(f"📦 Archivar temporada {temp_sel}"):
+                with st.spinner("Archivando..."): movidos = archivar_temporada_db(temp_sel)
+                if movidos: st.success(f"{movidos} pedidos de {temp_sel} archivados.")
+        else: st.info("No hay temporadas cerradas en la hoja activa.")
     
     elif menu == "📦 Inventario":
         st.title("📦 Inventario en Nube (Google Sheets)")
         st.info("ℹ️ Para agregar o modificar libros, edita directamente tu archivo 'DB_Libros_Escolares' en Google Drive.")
         df = cargar_inventario()
         if not df.empty:
-            df_ed = st.data_editor(df, num_rows="dynamic", use_container_width=True)
-            if st.button("💾 Guardar Cambios Rápidos"):
-                guardar_inventario(df_ed)
+            # Grado y Área como texto para poder escribir valores nuevos
+            df_ed = st.data_editor(df.astype({c: str for c in CATEGORIAS_INVENTARIO if c in df.columns}),
+                                   num_rows="dynamic", use_container_width=True)
+            if st.button("💾 Guardar Cambios Rápidos") and guardar_inventario(df_ed):
                 st.success("¡Inventario actualizado!")
                 st.rerun()
             st.divider()
-            try:
-                df['Ganancia'] = df['Precio Venta'] - df['Costo']
-                res = df.groupby("Grado")[["Costo", "Precio Venta", "Ganancia"]].sum()
-                st.dataframe(res, use_container_width=True)
+            try: st.dataframe(resumen_inventario(), use_container_width=True)
             except: pass
         else: st.warning("Inventario vacío.")
 
     elif menu == "📊 Ventas":
         st.title("📊 Panel Ventas (Google Sheets)")
+        # Una sola lectura por corrida completa; cada sección trabaja sobre esta foto
         df = cargar_pedidos()
+        inv = cargar_inventario()
         
         c1, c2 = st.columns(2)
         with c1:
@@ -581,184 +2699,39 @@ def vista_admin():
         st.divider()
         with st.expander("➕ Pedido Manual"):
             st.caption("Usa esto si un padre está contigo en persona.")
-            inv = cargar_inventario()
-            if not inv.empty:
-                mn, mc = st.columns(2)
-                nom = mn.text_input("Cliente", key="mn")
-                cel = mc.text_input("Cel", key="mc")
-                its, tot = componente_seleccion_libros(inv, "man", reset_counter=st.session_state.reset_manual)
-                st.metric("Total", f"${tot:,.0f}")
-                abo = st.number_input("Abono:", step=1000.0)
-                est = st.selectbox("Estado:", ["Nuevo", "Pagado Total", "Entregado"])
-                
-                if st.button("Guardar Manual"):
-                    if not nom: st.error("Nombre?")
-                    else:
-                        fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        nid = obtener_nuevo_id(df)
-                        nuevo = {
-                            "ID_Pedido": nid, "Fecha_Creacion": fecha, "Ultima_Modificacion": fecha,
-                            "Cliente": nom, "Celular": cel, "Detalle": " | ".join(its),
-                            "Total": tot, "Abonado": abo, "Saldo": tot - abo, "Estado": est,
-                            "Comprobante": "Manual", "Comprobante2": "No", "Historial_Cambios": "Admin Manual"
-                        }
-                        df = pd.concat([df, pd.DataFrame([nuevo])], ignore_index=True)
-                        guardar_pedido_db(df)
-                        st.success(f"Guardado ID: {nid}")
-                        st.session_state.reset_manual += 1
-                        st.rerun()
+            if not inv.empty: seccion_pedido_manual(inv)
 
         st.divider()
         st.subheader("Listado de Pedidos")
-        inv_act = cargar_inventario()
-        if not df.empty and not inv_act.empty:
-            excel = generar_excel_matriz_bytes(df, inv_act)
-            st.download_button("📥 Descargar Reporte", excel, "Reporte_Matriz.xlsx")
-            
-        filtro = st.text_input("Buscar Pedido:")
-        df_view = df
-        if filtro: df_view = df[df['Cliente'].str.contains(filtro, case=False, na=False)]
-        
-        vista_modo = st.radio("Modo de Visualización:", ["Vista Lista (Edición Rápida)", "Vista Matriz (Detallada)"], horizontal=True)
-        
-        if vista_modo == "Vista Lista (Edición Rápida)":
-            cols_base = ["ID_Pedido", "Fecha_Creacion", "Ultima_Modificacion", "Cliente", "Estado", "Total", "Abonado", "Saldo", "Celular"]
-            cols_extra = [c for c in df_view.columns if c not in cols_base]
-            df_view = df_view[cols_base + cols_extra]
-            
-            def resaltar_modificaciones(row):
-                estilo = [''] * len(row)
-                try:
-                    if row['Ultima_Modificacion'] > row['Fecha_Creacion']:
-                        idx = row.index.get_loc('Ultima_Modificacion')
-                        estilo[idx] = 'color: #d9534f; font-weight: bold;'
-                except: pass
-                return estilo
-
-            st.caption("💡 Fechas en rojo indican modificaciones posteriores. **Nota:** Puedes editar el 'Estado', 'Abonado' y 'Saldo' en la tabla de abajo.")
-            st.dataframe(df_view.style.apply(resaltar_modificaciones, axis=1), use_container_width=True)
-            
-            st.markdown("**Editar Registros Financieros y de Estado:**")
-            edited = st.data_editor(
-                df_view[["ID_Pedido", "Cliente", "Estado", "Abonado", "Saldo"]],
-                column_config={
-                    "Estado": st.column_config.SelectboxColumn(options=["Nuevo", "Pagado", "En Impresión", "Entregado", "Anulado"]),
-                    "ID_Pedido": st.column_config.TextColumn(disabled=True),
-                    "Cliente": st.column_config.TextColumn(disabled=True),
-                },
-                hide_index=True, use_container_width=True, key="editor_rapido"
-            )
-            
-            if st.button("💾 Guardar Cambios"):
-                cambios = False
-                fecha_actual = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                for idx, row in edited.iterrows():
-                    mask = df['ID_Pedido'] == row['ID_Pedido']
-                    if mask.any():
-                        fila_original = df.loc[mask].iloc[0]
-                        hubo_cambio_fila = False
-                        
-                        if fila_original['Estado'] != row['Estado']:
-                            df.loc[mask, 'Estado'] = row['Estado']
-                            hubo_cambio_fila = True
-                            
-                        abo_original = limpiar_moneda(fila_original['Abonado'])
-                        abo_nuevo = limpiar_moneda(row['Abonado'])
-                        if abo_original != abo_nuevo:
-                            df.loc[mask, 'Abonado'] = row['Abonado']
-                            hubo_cambio_fila = True
-                            
-                        saldo_original = limpiar_moneda(fila_original['Saldo'])
-                        saldo_nuevo = limpiar_moneda(row['Saldo'])
-                        if saldo_original != saldo_nuevo:
-                             df.loc[mask, 'Saldo'] = row['Saldo']
-                             hubo_cambio_fila = True
-                             
-                        if hubo_cambio_fila:
-                            df.loc[mask, 'Ultima_Modificacion'] = fecha_actual
-                            cambios = True
-
-                if cambios:
-                    guardar_pedido_db(df)
-                    st.success("¡Registros guardados con éxito!")
-                    st.rerun()
-                else: st.info("No detecté cambios.")
-        
-        else:
-            st.info("ℹ️ Visualización de items comprados por grado.")
-            if not inv_act.empty:
-                grados_disp = inv_act['Grado'].unique()
-                grado_sel = st.selectbox("Selecciona Grado:", grados_disp)
-                if grado_sel:
-                    inv_g = inv_act[inv_act['Grado'] == grado_sel]
-                    areas = inv_g['Area'].unique()
-                    patron = f"[{grado_sel}]"
-                    df_grado = df_view[df_view['Detalle'].str.contains(patron, regex=False, na=False)].copy()
-                    if not df_grado.empty:
-                        for a in areas: df_grado[a] = False
-                        for idx, row in df_grado.iterrows():
-                            items = str(row['Detalle']).split(" | ")
-                            for item in items:
-                                if patron in item:
-                                    match = re.search(r'\((.*?)\)', item)
-                                    if match:
-                                        pos = match.group(1).strip()
-                                        for a in areas:
-                                            if str(a).strip().lower() == pos.lower():
-                                                df_grado.at[idx, a] = True
-                        
-                        cols_ver = ["ID_Pedido", "Fecha_Creacion", "Ultima_Modificacion", "Cliente", "Estado"] + list(areas)
-                        st.dataframe(df_grado[cols_ver], hide_index=True, use_container_width=True)
-                    else: st.warning(f"No hay pedidos para {grado_sel}")
+        if not inv.empty and (not df.empty or temporadas_archivadas()): seccion_reporte()
+        seccion_listado(df, inv)
 
         st.divider()
         st.subheader("Gestión Detallada")
-        opts = df['ID_Pedido'] + " - " + df['Cliente']
-        bf = st.text_input("Filtrar Gestión:", placeholder="ID o Nombre...")
-        if bf: opts = opts[opts.str.contains(bf, case=False, na=False)]
-        
-        lista_clientes = ["-Selección del cliente-"] + list(opts)
-        sel_g = st.selectbox("Seleccionar:", lista_clientes)
-        
-        if sel_g and sel_g != "-Selección del cliente-":
-            id_sel = sel_g.split(" - ")[0]
-            row_sel = df[df['ID_Pedido'] == id_sel].iloc[0]
-            
-            c1, c2, c3 = st.columns(3)
-            with c1:
-                st.caption("Soporte 1")
-                s1 = str(row_sel.get('Comprobante', 'No'))
-                if s1.startswith("http"): st.image(s1, caption="Soporte 1", use_container_width=True)
-                else: st.info("Sin imagen Online")
-            with c2:
-                st.caption("Soporte 2")
-                s2 = str(row_sel.get('Comprobante2', 'No'))
-                if s2.startswith("http"): st.image(s2, caption="Soporte 2", use_container_width=True)
-                else: st.info("-")
-            with c3:
-                if st.button("🗑️ ELIMINAR PEDIDO", type="primary"):
-                    df = df[df['ID_Pedido'] != id_sel]
-                    guardar_pedido_db(df)
-                    st.success("Eliminado")
-                    st.rerun()
+        seccion_gestion(df)
 
 qp = st.query_params
 rol = qp.get("rol")
-if rol == "cliente":
-    if st.session_state.exito_cliente and st.session_state.ultimo_pedido_cliente:
-        vista_exito(st.session_state.ultimo_pedido_cliente)
-    else: vista_cliente(qp.get("pedido_id"))
-else:
-    if not st.session_state.admin_autenticado:
-        st.markdown("<br><br>", unsafe_allow_html=True)
-        _, c, _ = st.columns([1,2,1])
-        with c:
-            st.title("🔒 Admin")
-            pwd = st.text_input("Contraseña:", type="password")
-            if st.button("Entrar"):
-                if pwd == st.secrets.get("PASSWORD_ADMIN", "12345"):
-                    st.session_state.admin_autenticado = True
-                    st.rerun()
-                else: st.error("Incorrecto")
+metricas = obtener_metricas()
+metricas.iniciar_corrida(rol or "admin")
+try:
+    if rol == "cliente":
+        if st.session_state.exito_cliente and st.session_state.ultimo_pedido_cliente:
+            vista_exito(st.session_state.ultimo_pedido_cliente)
+        else: vista_cliente(qp.get("pedido_id"))
     else:
-        vista_admin()
\ No newline at end of file
+        if not st.session_state.admin_autenticado:
+            st.markdown("<br><br>", unsafe_allow_html=True)
+            _, c, _ = st.columns([1,2,1])
+            with c:
+                st.title("🔒 Admin")
+                pwd = st.text_input("Contraseña:", type="password")
+                if st.button("Entrar"):
+                    if pwd == st.secrets.get("PASSWORD_ADMIN", "12345"):
+                        st.session_state.admin_autenticado = True
+                        st.rerun()
+                    else: st.error("Incorrecto")
+        else:
+            vista_admin()
+except ErrorAlmacen as e: mostrar_error_almacen(e)
+finally: metricas.cerrar_corrida()
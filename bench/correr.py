@@ -0,0 +1,185 @@
+"""Benchmarks de app.py sin la hoja real.
+
+Uso (desde la raíz del repositorio):
+
+    python bench/correr.py                              # 1k, 10k y 100k pedidos
+    python bench/correr.py --pedidos 1000 --latencia-ms 80
+    python bench/correr.py --salida nuevo.json --comparar bench/resultados.json
+
+Carga app.py en modo "bare" de Streamlit contra un libro en memoria (o SQLite) y
+guarda tiempos y llamadas a la API por escenario en un JSON.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import gspread
+import pandas as pd
+from google.oauth2 import service_account
+
+import datos
+import gspread_falso
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def cargar_app(almacen, ventana_ms):
+    # secrets.toml temporal: Streamlit lo busca en el directorio actual
+    carpeta = tempfile.mkdtemp(prefix="bench_libros_")
+    os.makedirs(os.path.join(carpeta, ".streamlit"))
+    with open(os.path.join(carpeta, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write(f'google_json = "{{}}"\nALMACEN = "{almacen}"\nSQLITE_RUTA = "bench.db"\n'
+                f'CACHE_TTL = 3600\nESCRITURA_VENTANA_MS = {ventana_ms}\n'
+                # Sin tope de cuota: se mide el costo de cada operación, no las esperas del limitador
+                'CUOTA_POR_MINUTO = 1000000\n')
+    os.chdir(carpeta)
+
+    libro = gspread_falso.LibroFalso({"Inventario": [], "Pedidos": [], "Config": [["Clave", "Valor"]]})
+    gspread.authorize = lambda creds: gspread_falso.ClienteFalso(libro)
+    service_account.Credentials.from_service_account_info = classmethod(lambda cls, info, scopes=None: object())
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+    spec = importlib.util.spec_from_file_location("app", os.path.join(RAIZ, "app.py"))
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+    return app, libro
+
+
+def poblar(app, libro, almacen, n, semilla):
+    inventario = datos.generar_inventario(semilla=semilla)
+    pedidos = datos.generar_pedidos(n, inventario, semilla=semilla)
+    if almacen == "sheets":
+        libro.hojas["Inventario"].filas = inventario
+        libro.hojas["Pedidos"].filas = pedidos
+        libro.hojas["Config"].filas = [["Clave", "Valor"], ["celular_nequi", "3000000000"]]
+        # Sin hoja de reservas: la numeración de IDs se vuelve a sembrar desde estos pedidos
+        libro.hojas.pop("Reservas", None)
+        app.conectar_sheets().reiniciar()
+    else:
+        destino = app.obtener_almacen()
+        destino.guardar_inventario(app.normalizar_inventario(pd.DataFrame(inventario[1:], columns=inventario[0])))
+        destino.reescribir_pedidos(app.normalizar_pedidos(pd.DataFrame(pedidos[1:], columns=pedidos[0])))
+    cache = app.obtener_cache()
+    for hoja in ["Inventario", "Pedidos", "Config", "Archivo", "Temporadas"]: cache.invalidar(hoja)
+    return pedidos
+
+
+def medir(resultados, escenario, n, funcion, repeticiones=1):
+    gspread_falso.LLAMADAS.clear()
+    inicio = time.perf_counter()
+    for _ in range(repeticiones): valor = funcion()
+    segundos = (time.perf_counter() - inicio) / repeticiones
+    resultados.append({"escenario": escenario, "pedidos": n, "segundos": round(segundos, 6),
+                       "llamadas": dict(gspread_falso.LLAMADAS)})
+    print(f"  {escenario:<38} {segundos * 1000:>10.2f} ms  {dict(gspread_falso.LLAMADAS)}")
+    return valor
+
+
+def escenarios(app, libro, almacen, n, semilla, resultados):
+    filas = poblar(app, libro, almacen, n, semilla)
+    cache = app.obtener_cache()
+    print(f"{n} pedidos")
+
+    def cargar_frio():
+        cache.invalidar("Pedidos")
+        return app.cargar_pedidos()
+    df = medir(resultados, "cargar_pedidos (hoja)", n, cargar_frio)
+    medir(resultados, "cargar_pedidos (caché)", n, app.cargar_pedidos, 20)
+    print(f"  memoria de la tabla de pedidos: {df.memory_usage(deep=True).sum() / 1e6:.2f} MB")
+    medir(resultados, "filtrar por estado y fecha", n,
+          lambda: df[(df["Estado"] == "Pagado") & (df["Ultima_Modificacion"] > df["Fecha_Creacion"])], 20)
+
+    # Copia vencida: se sincroniza por deltas leyendo solo A:C y las filas que cambiaron
+    def sincronizar(cambiar=0):
+        for i in range(cambiar):
+            fila = libro.hojas["Pedidos"].filas[1 + (i * 97) % n] if almacen == "sheets" else None
+            if fila: fila[2] = f"2099-01-01 00:00:{i % 60:02d}"
+        ttl, cache.ttl = cache.ttl, 0
+        try: return app.cargar_pedidos()
+        finally: cache.ttl = ttl
+    medir(resultados, "cargar_pedidos (delta, sin cambios)", n, sincronizar)
+    medir(resultados, "cargar_pedidos (delta, 10 cambios)", n, lambda: sincronizar(10))
+    inventario = app.cargar_inventario()
+
+    medir(resultados, "obtener_nuevo_id (recorrido)", n, lambda: app.obtener_nuevo_id(df))
+    medir(resultados, "reservar_id_pedido (secuencia)", n, app.reservar_id_pedido)
+
+    def insertar():
+        registro = dict(zip(datos.COLUMNAS_PEDIDOS, filas[1]))
+        registro.update(ID_Pedido=app.reservar_id_pedido(), Cliente="Bench", Total=1000.0, Abonado=0.0, Saldo=1000.0)
+        return app.insertar_pedido_db(registro)
+    medir(resultados, "guardar pedido nuevo", n, insertar)
+    medir(resultados, "actualizar un campo", n, lambda: app.actualizar_pedido_db(filas[n // 2][0], {"Estado": "Pagado"}))
+
+    celulares = [filas[1 + i * (n - 1) // 99][4] for i in range(100)]
+    medir(resultados, "celular: primera búsqueda (índice)", n, lambda: app.pedidos_por_celular(celulares[0]))
+    consultas = iter(celulares * 2)
+    medir(resultados, "celular: búsqueda", n, lambda: app.pedidos_por_celular(next(consultas)), 100)
+
+    # Buscador del panel: nombres sin tildes, celulares e IDs por prefijo
+    medir(resultados, "buscador: construir índice", n, lambda: app.indice_busqueda())
+    nombres = [app.normalizar_clave(filas[1 + i * (n - 1) // 99][3]) for i in range(100)]
+    consultas = iter(nombres * 2)
+    medir(resultados, "buscador: nombre completo", n, lambda: app.indice_busqueda().buscar(next(consultas)), 100)
+
+    items = medir(resultados, "items_pedidos (parseo Detalle)", n, app.items_pedidos)
+    medir(resultados, "tablero: construir agregados", n, lambda: app.agregados_pedidos().tablas())
+    app.actualizar_pedido_db(filas[n // 3][0], {"Estado": "En Impresión", "Saldo": 0})
+    medir(resultados, "tablero: tras un guardado", n, lambda: app.agregados_pedidos().tablas())
+    df = app.cargar_pedidos()
+    medir(resultados, "generar_excel_matriz_bytes", n, lambda: app.generar_excel_matriz_bytes(df, inventario, items))
+
+    def edicion_rapida():
+        pagina = df.iloc[:50][["ID_Pedido", "Cliente", "Estado", "Abonado", "Saldo"]].copy()
+        pagina.loc[pagina.index[::3], "Estado"] = "Entregado"
+        pagina.loc[pagina.index[1::5], "Abonado"] = pagina["Abonado"] + 1000
+        cambios = app.cambios_edicion_rapida(df, pagina, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        return app.guardar_cambios_pedidos(cambios)
+    medir(resultados, "edición rápida (50 filas)", n, edicion_rapida)
+
+
+def comparar(actual, base):
+    previos = {(r["escenario"], r["pedidos"]): r["segundos"] for r in base["resultados"]}
+    print(f"\n{'escenario':<38} {'pedidos':>8} {'base ms':>10} {'actual ms':>10} {'x':>6}")
+    for r in actual["resultados"]:
+        previo = previos.get((r["escenario"], r["pedidos"]))
+        if previo is None: continue
+        razon = r["segundos"] / previo if previo else float("inf")
+        marca = "  <-- más lento" if razon > 1.25 else ""
+        print(f"{r['escenario']:<38} {r['pedidos']:>8} {previo * 1000:>10.2f} {r['segundos'] * 1000:>10.2f} {razon:>6.2f}{marca}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pedidos", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--almacen", choices=["sheets", "sqlite"], default="sheets")
+    parser.add_argument("--latencia-ms", type=float, default=0, help="espera simulada por llamada a la API")
+    parser.add_argument("--ventana-ms", type=int, default=0, help="ESCRITURA_VENTANA_MS de la cola de escritura")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--salida", default=os.path.join(RAIZ, "bench", "resultados.json"))
+    parser.add_argument("--comparar", help="JSON de una corrida anterior")
+    args = parser.parse_args()
+    salida = os.path.abspath(args.salida)
+    base = json.load(open(args.comparar, encoding="utf-8")) if args.comparar else None
+
+    app, libro = cargar_app(args.almacen, args.ventana_ms)
+    gspread_falso.Latencia.segundos = args.latencia_ms / 1000
+
+    resultados = []
+    for n in args.pedidos: escenarios(app, libro, args.almacen, n, args.semilla, resultados)
+    informe = {"fecha": datetime.now().isoformat(timespec="seconds"), "almacen": args.almacen,
+               "latencia_ms": args.latencia_ms, "ventana_ms": args.ventana_ms,
+               "python": sys.version.split()[0], "pandas": pd.__version__, "resultados": resultados}
+    with open(salida, "w", encoding="utf-8") as f: json.dump(informe, f, ensure_ascii=False, indent=2)
+    print(f"\nResultados en {salida}")
+    if base: comparar(informe, base)
+
+
+if __name__ == "__main__":
+    main()
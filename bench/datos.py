@@ -0,0 +1,67 @@
+"""Generador de datos sintéticos (inventario y pedidos) con la forma de las hojas reales."""
+import random
+
+COLUMNAS_PEDIDOS = [
+    "ID_Pedido", "Fecha_Creacion", "Ultima_Modificacion", "Cliente",
+    "Celular", "Detalle", "Total", "Abonado", "Saldo", "Estado",
+    "Comprobante", "Comprobante2", "Historial_Cambios"
+]
+COLUMNAS_INVENTARIO = ["Grado", "Area", "Libro", "Costo", "Precio Venta"]
+
+GRADOS = ["Transición", "1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11"]
+AREAS = ["Matemáticas", "Español", "Ciencias Naturales", "Sociales", "Inglés", "Ética", "Artística"]
+NOMBRES = ["Ana", "Luis", "José", "María", "Camila", "Andrés", "Valentina", "Juan", "Sofía", "Mateo"]
+APELLIDOS = ["Martínez", "Pérez", "Núñez", "López", "Gómez", "Rodríguez", "Díaz", "Hernández"]
+ESTADOS = ["Nuevo", "Pagado", "En Impresión", "Entregado", "Anulado"]
+
+
+def generar_inventario(libros_por_area=1, semilla=1):
+    """Filas de Inventario (encabezado incluido): grados x áreas x libros, con precios en formatos mixtos."""
+    r = random.Random(semilla)
+    filas = [COLUMNAS_INVENTARIO]
+    for grado in GRADOS:
+        for area in AREAS:
+            for n in range(libros_por_area):
+                costo = r.randrange(8000, 20000, 500)
+                precio = costo + r.randrange(3000, 12000, 500)
+                formato = r.choice([str(precio), f"${precio:,}", f"{precio}.0"])
+                filas.append([grado, area, f"{area} {grado}" + (f" {n + 1}" if n else ""), str(costo), formato])
+    return filas
+
+
+def _detalle(r, libros, legado):
+    items, total = [], 0.0
+    for grado, area, libro, precio in r.sample(libros, r.randint(1, 6)):
+        # Formato actual "[grado] (area) libro" y el antiguo "[grado] libro"
+        items.append(f"[{grado}] {libro}" if r.random() < legado else f"[{grado}] ({area}) {libro}")
+        total += precio
+    return " | ".join(items), total
+
+
+def generar_pedidos(n, inventario, semilla=1, legado=0.2, anio=2025):
+    """Filas de Pedidos (encabezado incluido) como quedan en la hoja: todo texto, montos con formatos mixtos.
+
+    `legado` es la fracción de items escritos con el formato antiguo sin área. Los
+    celulares se repiten (un padre con varios pedidos) para que las búsquedas tengan coincidencias.
+    """
+    r = random.Random(semilla)
+    libros = [(f[0], f[1], f[2], float(f[4].replace("$", "").replace(",", ""))) for f in inventario[1:]]
+    celulares = [f"3{r.randrange(10**8, 10**9)}" for _ in range(max(1, n // 2))]
+    filas = [COLUMNAS_PEDIDOS]
+    for i in range(n):
+        detalle, total = _detalle(r, libros, legado)
+        abonado = r.choice([0, total // 2, total])
+        # Fechas crecientes a lo largo del año, como llegan los pedidos
+        dia = i * 336 // max(n, 1)
+        fecha = f"{anio}-{1 + dia // 28:02d}-{1 + dia % 28:02d}"
+        hora = r.randint(7, 20)
+        creado = f"{fecha} {hora:02d}:{r.randint(0, 59):02d}:00"
+        modificado = creado if r.random() < 0.7 else f"{fecha} {hora + 3:02d}:00:00"
+        celular = r.choice(celulares)
+        celular = r.choice([celular, f"{celular[:3]} {celular[3:6]} {celular[6:]}", f"{celular[:3]}-{celular[3:]}"])
+        filas.append([
+            f"{i + 1:04d}", creado, modificado, f"{r.choice(NOMBRES)} {r.choice(APELLIDOS)}", celular, detalle,
+            r.choice([str(int(total)), f"${int(total):,}"]), str(int(abonado)), str(int(total - abonado)),
+            r.choice(ESTADOS), r.choice(["No", "https://ejemplo.com/soporte.png", "Manual"]), "No", "Original"
+        ])
+    return filas
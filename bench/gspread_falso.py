@@ -0,0 +1,177 @@
+"""Libro de Google Sheets en memoria: mismas llamadas que usa app.py, con conteo y latencia simulada."""
+import json
+import re
+import threading
+import time
+from collections import Counter
+
+import gspread
+import requests
+from gspread.utils import numericise_all
+
+LLAMADAS = Counter()
+
+
+class Latencia:
+    # Segundos de espera por llamada a la "API"; 0 mide solo el costo local
+    segundos = 0.0
+
+
+def _llamada(nombre):
+    LLAMADAS[nombre] += 1
+    if Latencia.segundos: time.sleep(Latencia.segundos)
+
+
+def _error_api(codigo, mensaje, estado):
+    # Misma forma que las respuestas de error de la API: gspread arma el APIError desde el JSON
+    respuesta = requests.models.Response()
+    respuesta.status_code = codigo
+    respuesta._content = json.dumps({"error": {"code": codigo, "message": mensaje, "status": estado}}).encode()
+    return gspread.exceptions.APIError(respuesta)
+
+
+def _celda(a1):
+    m = re.match(r"([A-Z]*)(\d*)", a1)
+    columna = 0
+    for letra in m.group(1): columna = columna * 26 + ord(letra) - 64
+    return (int(m.group(2)) if m.group(2) else None), (columna or None)
+
+
+def _rango(rango):
+    if "!" in rango: rango = rango.split("!")[1]
+    partes = rango.split(":")
+    f1, c1 = _celda(partes[0])
+    f2, c2 = _celda(partes[1]) if len(partes) > 1 else (f1, c1)
+    return f1, c1, f2, c2
+
+
+class HojaFalsa:
+    _ids = 0
+
+    def __init__(self, titulo, filas=None):
+        HojaFalsa._ids += 1
+        self.id = HojaFalsa._ids
+        self.title = titulo
+        self.filas = [[str(v) for v in f] for f in (filas or [])]
+        self._columnas = 26
+
+    def _crecer(self, fila, columna):
+        while len(self.filas) < fila: self.filas.append([])
+        actual = self.filas[fila - 1]
+        while len(actual) < columna: actual.append("")
+
+    def _escribir(self, rango, valores):
+        f1, c1, _, _ = _rango(rango) if rango else (1, 1, None, None)
+        f1, c1 = f1 or 1, c1 or 1
+        for i, fila in enumerate(valores):
+            for j, v in enumerate(fila):
+                self._crecer(f1 + i, c1 + j)
+                self.filas[f1 + i - 1][c1 + j - 1] = "" if v is None else str(v)
+
+    @property
+    def col_count(self):
+        return max(self._columnas, max((len(f) for f in self.filas), default=0))
+
+    def add_cols(self, n):
+        _llamada("add_cols")
+        self._columnas = self.col_count + n
+
+    def get_all_records(self, numericise_ignore=None, **kw):
+        _llamada("get_all_records")
+        if not self.filas: return []
+        encabezado = self.filas[0]
+        ignorar = numericise_ignore or []
+        if "all" in ignorar: ignorar = list(range(1, len(encabezado) + 1))
+        registros = []
+        for fila in self.filas[1:]:
+            fila = (fila + [""] * len(encabezado))[:len(encabezado)]
+            registros.append(dict(zip(encabezado, numericise_all(fila, ignore=ignorar))))
+        return registros
+
+    def col_values(self, columna, **kw):
+        _llamada("col_values")
+        valores = [f[columna - 1] if len(f) >= columna else "" for f in self.filas]
+        while valores and valores[-1] == "": valores.pop()
+        return valores
+
+    def get_values(self, rango=None, **kw):
+        _llamada("get_values")
+        if rango is None: return [list(f) for f in self.filas]
+        f1, c1, f2, c2 = _rango(rango)
+        f1, c1 = f1 or 1, c1 or 1
+        salida = []
+        for fila in self.filas[f1 - 1:(f2 or len(self.filas))]:
+            tramo = fila[c1 - 1:(c2 or len(fila))]
+            while tramo and tramo[-1] == "": tramo = tramo[:-1]
+            salida.append(tramo)
+        while salida and not salida[-1]: salida.pop()
+        return salida
+
+    def batch_get(self, rangos, **kw):
+        _llamada("batch_get")
+        salida = []
+        for rango in rangos:
+            f1, c1, f2, c2 = _rango(rango)
+            salida.append([(fila[c1 - 1:c2] + [""] * c2)[:c2 - c1 + 1] for fila in self.filas[f1 - 1:f2]])
+        return salida
+
+    def update(self, values=None, range_name=None, **kw):
+        _llamada("update")
+        self._escribir(range_name, values)
+        return {}
+
+    def batch_update(self, datos, **kw):
+        _llamada("batch_update")
+        for d in datos: self._escribir(d["range"], d["values"])
+        return {}
+
+    def append_rows(self, valores, **kw):
+        _llamada("append_rows")
+        while self.filas and not any(self.filas[-1]): self.filas.pop()
+        inicio = len(self.filas) + 1
+        self.filas.extend([str(v) for v in fila] for fila in valores)
+        # Misma forma que la respuesta de values.append de la API
+        return {"updates": {"updatedRange": f"{self.title}!A{inicio}:{len(self.filas)}"}}
+
+    def delete_rows(self, inicio, fin=None, **kw):
+        _llamada("delete_rows")
+        del self.filas[inicio - 1:(fin or inicio)]
+        return {}
+
+    def clear(self):
+        _llamada("clear")
+        self.filas = []
+
+
+class LibroFalso:
+    def __init__(self, hojas):
+        self.hojas = {titulo: HojaFalsa(titulo, filas) for titulo, filas in hojas.items()}
+        self._lock = threading.Lock()
+
+    def worksheet(self, titulo):
+        _llamada("worksheet")
+        if titulo not in self.hojas: raise gspread.exceptions.WorksheetNotFound(titulo)
+        return self.hojas[titulo]
+
+    def worksheets(self):
+        _llamada("worksheets")
+        return list(self.hojas.values())
+
+    def add_worksheet(self, title, rows=100, cols=20, **kw):
+        _llamada("add_worksheet")
+        # Como Sheets: un título repetido es un 400, nunca reemplaza la hoja existente
+        with self._lock:
+            if title in self.hojas:
+                raise _error_api(400, f'Invalid requests[0].addSheet: A sheet with the name "{title}" already exists. '
+                                      'Please enter another name.', "INVALID_ARGUMENT")
+            self.hojas[title] = HojaFalsa(title)
+            return self.hojas[title]
+
+
+class ClienteFalso:
+    def __init__(self, libro):
+        self.libro = libro
+
+    def open_by_key(self, clave):
+        _llamada("open_by_key")
+        return self.libro
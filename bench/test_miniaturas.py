@@ -0,0 +1,97 @@
+"""Pruebas de CacheMiniaturas contra un servidor HTTP local.
+
+Uso (desde la raíz del repositorio):
+
+    python bench/test_miniaturas.py
+    python -m pytest bench/test_miniaturas.py
+
+Cubre la descarga y reducción, la lectura desde disco sin volver a pedir la URL
+y el recuerdo de las URLs que fallan.
+"""
+import http.server
+import io
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import correr
+
+
+class Servidor(http.server.ThreadingHTTPServer):
+    """Sirve /ok.png (una imagen de 1200×800) y responde 404 a todo lo demás; cuenta pedidos por ruta."""
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), Manejador)
+        self.pedidos = {}
+        imagen = io.BytesIO()
+        Image.new("RGB", (1200, 800), (200, 30, 30)).save(imagen, "PNG")
+        self.imagen = imagen.getvalue()
+
+    def url(self, ruta):
+        return f"http://127.0.0.1:{self.server_address[1]}{ruta}"
+
+
+class Manejador(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.pedidos[self.path] = self.server.pedidos.get(self.path, 0) + 1
+        if self.path != "/ok.png":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(self.server.imagen)))
+        self.end_headers()
+        self.wfile.write(self.server.imagen)
+
+    def log_message(self, *args):
+        pass
+
+
+class PruebasMiniaturas(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app, _ = correr.cargar_app("sheets", 0)
+        cls.servidor = Servidor()
+        threading.Thread(target=cls.servidor.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.servidor.shutdown()
+        cls.servidor.server_close()
+
+    def setUp(self):
+        self.servidor.pedidos.clear()
+        self.cache = self.app.CacheMiniaturas(tempfile.mkdtemp(prefix="miniaturas_"), 10 * 1024 * 1024)
+
+    def test_descarga_y_reduce(self):
+        ruta = self.cache.obtener(self.servidor.url("/ok.png"))
+        self.assertIsNotNone(ruta)
+        with Image.open(ruta) as imagen:
+            self.assertEqual(imagen.format, "JPEG")
+            self.assertLessEqual(max(imagen.size), self.cache.LADO)
+
+    def test_segunda_lectura_sale_del_disco(self):
+        url = self.servidor.url("/ok.png")
+        primera = self.cache.obtener(url)
+        self.assertEqual(self.cache.obtener(url), primera)
+        self.cache.precargar([url, url])
+        self.assertEqual(self.servidor.pedidos, {"/ok.png": 1})
+
+    def test_fallo_no_se_repite_hasta_el_reintento(self):
+        url = self.servidor.url("/no-existe.png")
+        self.assertIsNone(self.cache.obtener(url))
+        self.assertIsNone(self.cache.obtener(url))
+        self.cache.precargar([url])
+        self.assertEqual(self.servidor.pedidos, {"/no-existe.png": 1})
+        # Vencido el plazo se vuelve a intentar
+        self.cache.REINTENTO_FALLIDA = 0
+        self.assertIsNone(self.cache.obtener(url))
+        self.assertEqual(self.servidor.pedidos, {"/no-existe.png": 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
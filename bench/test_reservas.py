@@ -0,0 +1,56 @@
+"""Pruebas de la reserva de IDs de pedido contra el libro en memoria.
+
+Uso (desde la raíz del repositorio):
+
+    python bench/test_reservas.py
+    python -m pytest bench/test_reservas.py
+
+Varias instancias (cada una con su propia conexión, como varios servidores) crean
+la hoja Reservas a la vez: las que pierden reciben el 400 de Sheets, reconectan y
+reservan sobre la hoja que ganó.
+"""
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import correr
+import gspread_falso
+
+
+class PruebasReservas(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app, cls.libro = correr.cargar_app("sheets", 0)
+
+    def setUp(self):
+        correr.poblar(self.app, self.libro, "sheets", 50, 1)
+        gspread_falso.Latencia.segundos = 0.01
+
+    def tearDown(self):
+        gspread_falso.Latencia.segundos = 0.0
+
+    def test_hoja_repetida_es_un_400(self):
+        with self.assertRaises(gspread_falso.gspread.exceptions.APIError) as error:
+            self.libro.add_worksheet("Pedidos")
+        self.assertEqual(error.exception.response.status_code, 400)
+
+    def test_creacion_simultanea_no_repite_ids(self):
+        app = self.app
+        almacenes = [app.AlmacenSheets(app.ConexionSheets(app.autorizar_cliente(), app.obtener_metricas(), app.obtener_limitador()))
+                     for _ in range(6)]
+        ids, errores = [], []
+        def reservar(almacen):
+            try:
+                for _ in range(4): ids.append(almacen.siguiente_id())
+            except Exception as e: errores.append(e)
+        hilos = [threading.Thread(target=reservar, args=(a,)) for a in almacenes]
+        for h in hilos: h.start()
+        for h in hilos: h.join()
+        self.assertEqual(errores, [])
+        self.assertEqual(sorted(ids), [f"{i:04d}" for i in range(51, 75)])
+
+
+if __name__ == "__main__":
+    unittest.main()